@@ -74,10 +74,10 @@ for exposure,thespecfiles in dict_exposures.items() :
         if not os.path.exists(savedir) : 
             os.mkdir(savedir)
             os.mkdir(savedir+"/vignettes")
-        plotframes.plotspectra(thespec, zcatalog=thezb, vidata=vidata, model=model, title=titlepage, savedir=savedir, is_coadded=False)
-        for i_spec in range(thespec.num_spectra()) :
-            saveplot = savedir+"/vignettes/expo"+str(exposure)+"_fiberset"+str(i_page)+"_"+str(i_spec)+".png"
-            utils_specviewer.miniplot_spectrum(thespec,i_spec,model=model,saveplot=saveplot, smoothing = args.vignette_smoothing)
+        context = utils_specviewer.ViewerContext(thespec)
+        plotframes.plotspectra(thespec, zcatalog=thezb, vidata=vidata, model=model, title=titlepage, savedir=savedir, is_coadded=False, context=context)
+        saveplots = [ savedir+"/vignettes/expo"+str(exposure)+"_fiberset"+str(i_page)+"_"+str(i_spec)+".png" for i_spec in range(thespec.num_spectra()) ]
+        utils_specviewer.miniplot_spectra(thespec, saveplots, model=model, smoothing = args.vignette_smoothing, context=context)
 
 
 
@@ -0,0 +1,56 @@
+// CustomJS, lazy loading of spectra stored in binary "sidecar" files, see plotframes.write_sidecar()
+
+function load_sidecar(ifiber, sidecar, sources, status) {
+    // ifiber : spectrum to be loaded, together with up to sidecar.nprefetch neighbours on each side
+    // sidecar : layout of sidecar files (dict from plotframes.write_sidecar)
+    // sources : list of CDS to which loaded arrays are added (as origflux<i>, orignoise<i>...)
+    // status : CDS whose data is updated once the arrays of spectrum status.waiting are loaded
+    //          (this re-triggers update_plot)
+    if (status.pending === undefined) status.pending = {}
+    var field0 = sidecar.fields[0]
+    function is_loaded(i) {
+        return (status.pending[i] == true) || ((field0.column+i) in sources[field0.source].data)
+    }
+    if (is_loaded(ifiber)) return
+
+    var i_file = Math.floor(ifiber / sidecar.nspec_per_file)
+    var first = i_file * sidecar.nspec_per_file
+    var last = Math.min(first + sidecar.nspec_per_file, sidecar.nspec) - 1
+    var lo = ifiber
+    var hi = ifiber
+    while (lo > first && lo > ifiber - sidecar.nprefetch && !is_loaded(lo-1)) lo--
+    while (hi < last && hi < ifiber + sidecar.nprefetch && !is_loaded(hi+1)) hi++
+    for (var i=lo; i<=hi; i++) status.pending[i] = true
+
+    // Records have a fixed size : the requested byte range follows from spectrum indices
+    var record_bytes = 4 * sidecar.record_size
+    var url = sidecar.files[i_file]
+    var byte_range = 'bytes=' + ((lo-first)*record_bytes) + '-' + ((hi-first+1)*record_bytes-1)
+    fetch(url, {headers: {'Range': byte_range}}).then(function(response) {
+        if (!response.ok) throw new Error('HTTP status ' + response.status)
+        // Servers ignoring Range requests send the full file (status 200)
+        var i_start = (response.status == 206) ? lo : first
+        return response.arrayBuffer().then(function(buffer) { return [i_start, buffer] })
+    }).then(function(result) {
+        var values = new Float32Array(result[1])
+        var nrecords = Math.floor(values.length / sidecar.record_size)
+        for (var r=0; r<nrecords; r++) {
+            var i_spec = result[0] + r
+            for (var k=0; k<sidecar.fields.length; k++) {
+                var field = sidecar.fields[k]
+                var start = r * sidecar.record_size + field.offset
+                sources[field.source].data[field.column+i_spec] = values.subarray(start, start+field.length)
+            }
+            delete status.pending[i_spec]
+        }
+        var waiting = status.waiting
+        if (waiting != null && waiting >= result[0] && waiting < result[0]+nrecords) {
+            status.waiting = null
+            status.data = {'loaded': [waiting]}
+        }
+    }).catch(function(error) {
+        for (var i=lo; i<=hi; i++) delete status.pending[i]
+        console.log('Could not load spectra from ' + url + ' : ' + error)
+    })
+}
+
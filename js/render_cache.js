@@ -0,0 +1,29 @@
+// CustomJS, in-page LRU cache of rendered spectra (smoothed arrays, camera coadd, y-range),
+// keyed by (ifiber, nsmooth). It is kept in window, so that it persists between calls to update_plot.
+
+function render_cache(name, size) {
+    // LRU cache of viewer name (several viewers may share a page, eg. in a notebook)
+    if (window.prospect_render_caches === undefined) window.prospect_render_caches = {}
+    if (!(name in window.prospect_render_caches)) {
+        window.prospect_render_caches[name] = {size: size, keys: [], entries: {}, prefetching: null}
+    }
+    return window.prospect_render_caches[name]
+}
+
+function cache_get(cache, key) {
+    // Returns the entry for key (or null), which becomes the most recently used one
+    if (!(key in cache.entries)) return null
+    cache.keys.splice(cache.keys.indexOf(key), 1)
+    cache.keys.push(key)
+    return cache.entries[key]
+}
+
+function cache_put(cache, key, entry) {
+    // Adds entry, removing the least recently used ones if the cache is full
+    if (cache.size <= 0) return
+    if (key in cache.entries) cache.keys.splice(cache.keys.indexOf(key), 1)
+    cache.entries[key] = entry
+    cache.keys.push(key)
+    while (cache.keys.length > cache.size) delete cache.entries[cache.keys.shift()]
+}
+
@@ -0,0 +1,74 @@
+// CustomJS, smoothing of spectra with the kernel K_i = exp(-i^2/(2*nsmooth)), |i| <= 2*nsmooth
+// NaN values are ignored (kernel weights are normalized over valid pixels only).
+// The full kernel is applied, so that results are those of the original smoothing ;
+// the inner loop only has bounds checks at edges.
+
+function smooth_data(data_in, nsmooth, quadrature=false) {
+    // by default : out_j ~ (sum K_i in_i) / (sum K_i)
+    // if quadrature is true (for noise) : out_j^2 ~ (sum K_i^2 in_i^2) / (sum K_i)^2
+    // Sums are restricted to non-NaN pixels (out_j is NaN if there is none). Returns a Float64Array.
+    var n = data_in.length
+    var values = new Float64Array(n)
+    var valid = new Float64Array(n)
+    for (var j=0; j<n; j++) {
+        var fx = data_in[j]
+        if (fx == fx) {
+            values[j] = quadrature ? fx*fx : fx
+            valid[j] = 1
+        }
+    }
+    var half = 2*nsmooth
+    var kernel = new Float64Array(2*half+1)
+    for (var k=-half; k<=half; k++) kernel[k+half] = Math.exp(-(k*k)/(2*nsmooth))
+    var kvals = quadrature ? kernel.map(function(x) { return x*x }) : kernel
+    var out = new Float64Array(n)
+    for (var j=0; j<n; j++) {
+        var k_start = Math.max(0, half-j)
+        var k_end = Math.min(2*half+1, n+half-j)
+        var num = 0
+        var weight = 0
+        for (var k=k_start; k<k_end; k++) {
+            num += kvals[k] * values[j+k-half]
+            weight += kernel[k] * valid[j+k-half]
+        }
+        out[j] = quadrature ? Math.sqrt(num)/weight : num/weight
+    }
+    return out
+}
+
+function smoothing_worker() {
+    // Web Worker running smooth_data (created once per page), or null if not available
+    if (window.prospect_smoothing_worker === undefined) {
+        window.prospect_smoothing_worker = null
+        try {
+            var code = smooth_data.toString() + '\n' +
+                'onmessage = function(e) {\n' +
+                '    var arrays = e.data.arrays.map(function(x) { return smooth_data(x[0], e.data.nsmooth, x[1]) })\n' +
+                '    postMessage({key: e.data.key, arrays: arrays}, arrays.map(function(x) { return x.buffer }))\n' +
+                '}\n'
+            var url = URL.createObjectURL(new Blob([code], {type: 'application/javascript'}))
+            window.prospect_smoothing_worker = new Worker(url)
+        } catch (error) {
+            console.log('Smoothing will not use a Web Worker : ' + error)
+        }
+    }
+    return window.prospect_smoothing_worker
+}
+
+function smooth_in_worker(key, arrays, nsmooth, status) {
+    // Sends arrays ([data, quadrature] pairs) to the smoothing worker.
+    // Result is stored in status.smoothed = {key, arrays}; status.data is then updated
+    // (which re-triggers update_plot) if key is still the one waited for.
+    var worker = smoothing_worker()
+    worker.onmessage = function(e) {
+        status.smoothed = e.data
+        if (status.waiting == e.data.key) {
+            status.waiting = null
+            status.data = {'smoothed': [e.data.key]}
+        }
+    }
+    status.waiting = key
+    // Arrays are copied with slice() : they may be views of a larger buffer (eg. from load_sidecar)
+    worker.postMessage({key: key, nsmooth: nsmooth, arrays: arrays.map(function(x) { return [x[0].slice(), x[1]] })})
+}
+
@@ -0,0 +1,80 @@
+// CustomJS, level-of-detail of spectra displayed in the main figure, see plotframes.decimate_minmax()
+
+function decimate_minmax(data, factor) {
+    // Min/max decimation of plotflux (and plotnoise) : each bucket of factor points is replaced
+    // by 2 points, at the first and last wavelengths of the bucket, with the min and max
+    // values of the bucket (in order of occurrence). NaN values are ignored.
+    var wave = data['origwave']
+    var columns = ('plotnoise' in data) ? ['plotflux', 'plotnoise'] : ['plotflux']
+    var nbuckets = Math.ceil(wave.length / factor)
+    var out = {'origwave': new Float64Array(2*nbuckets)}
+    for (var c=0; c<columns.length; c++) {
+        var values = data[columns[c]]
+        var out_values = new Float64Array(2*nbuckets)
+        for (var k=0; k<nbuckets; k++) {
+            var start = k*factor
+            var end = Math.min(start+factor, wave.length)
+            var imin = -1
+            var imax = -1
+            for (var j=start; j<end; j++) {
+                var v = values[j]
+                if (v != v) continue
+                if (imin < 0 || v < values[imin]) imin = j
+                if (imax < 0 || v > values[imax]) imax = j
+            }
+            if (imin < 0) {
+                out_values[2*k] = NaN
+                out_values[2*k+1] = NaN
+            } else {
+                out_values[2*k] = values[Math.min(imin, imax)]
+                out_values[2*k+1] = values[Math.max(imin, imax)]
+            }
+            if (c == 0) {
+                out['origwave'][2*k] = wave[start]
+                out['origwave'][2*k+1] = wave[end-1]
+            }
+        }
+        out[columns[c]] = out_values
+    }
+    return out
+}
+
+function lod_level(wave, waveshift, fig, lod_factors) {
+    // Coarsest factor in lod_factors (sorted by increasing values) still giving
+    // at least one point per screen pixel in the current x_range
+    function count_below(x) { // number of points with wave*waveshift < x (wave is sorted)
+        var lo = 0
+        var hi = wave.length
+        while (lo < hi) {
+            var mid = (lo + hi) >> 1
+            if (wave[mid]*waveshift < x) lo = mid+1
+            else hi = mid
+        }
+        return lo
+    }
+    var nvisible = count_below(fig.x_range.end) - count_below(fig.x_range.start)
+    var npix = (fig.inner_width > 0) ? fig.inner_width : fig.plot_width
+    for (var i=lod_factors.length-1; i>0; i--) {
+        if (2*nvisible/lod_factors[i] >= npix) return lod_factors[i]
+    }
+    return lod_factors[0]
+}
+
+function update_lod(sources, lod_sources, lod_keys, waveshift_cds, fig, lod_factors, force) {
+    // Fills lod_sources[i] from sources[i], at the level adapted to the current x_range
+    // force : if false, lod_sources[i] is updated only if its level changed
+    for (var i=0; i<sources.length; i++) {
+        var data = sources[i].data
+        var level = lod_level(data['origwave'], waveshift_cds.data[lod_keys[i]][0], fig, lod_factors)
+        if (!force && lod_sources[i].lod_level == level) continue
+        lod_sources[i].lod_level = level
+        if (level == 1) {
+            var lod_data = {'origwave': data['origwave'], 'plotflux': data['plotflux']}
+            if ('plotnoise' in data) lod_data['plotnoise'] = data['plotnoise']
+            lod_sources[i].data = lod_data
+        } else {
+            lod_sources[i].data = decimate_minmax(data, level)
+        }
+    }
+}
+
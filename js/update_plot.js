@@ -55,216 +55,209 @@ if(targetinfo.data['z'] != undefined && cb_obj == ifiberslider) {
     dzslider.value = (z - z1)
 }
 
+// Sidecar mode : arrays of spectrum ifiber may not be loaded yet.
+// In that case they are fetched, and update_plot is called again once they are available.
+if (sidecar) {
+    var field0 = sidecar.fields[0]
+    if ( !((field0.column+ifiber) in sidecar_sources[field0.source].data) ) {
+        sidecar_status.waiting = ifiber
+        load_sidecar(ifiber, sidecar, sidecar_sources, sidecar_status)
+        return
+    }
+    // Prefetch neighbours
+    load_sidecar(Math.min(ifiber+1, sidecar.nspec-1), sidecar, sidecar_sources, sidecar_status)
+    load_sidecar(Math.max(ifiber-1, 0), sidecar, sidecar_sources, sidecar_status)
+}
+
+// Same as utils_specviewer.get_y_minmax()
 function get_y_minmax(pmin, pmax, data) {
     // copy before sorting to not impact original, and filter out NaN
-    var dx = data.slice().filter(Boolean)
-    dx.sort()
+    var dx = Float64Array.from(data).filter(function(x) { return isFinite(x) })
+    if (dx.length == 0) return [0, 0]
+    dx.sort() // numerical sort, as dx is a typed array
     var imin = Math.floor(pmin * dx.length)
-    var imax = Math.floor(pmax * dx.length)
+    var imax = Math.min(Math.floor(pmax * dx.length), dx.length-1)
     return [dx[imin], dx[imax]]
 }
 
-// Smoothing kernel
-if (nsmooth > 0) {
-    var kernel = [];
-    for(var i=-2*nsmooth; i<=2*nsmooth; i++) {
-        kernel.push(Math.exp(-(i**2)/(2*nsmooth)))
-    }
-    var kernel_offset = Math.floor(kernel.length/2)
-}
-
-function smooth_data(data_in, kernel, kernel_offset, quadrature=false) {
-    // by default : out_j ~ (sum K_i in_i) / (sum K_i)
-    // if quadrature is true (for noise) : out_j^2 ~ (sum K_i^2 in_i^2) / (sum K_i)^2
-    var smoothed_data = data_in.slice()
-    for (var j=0; j<data_in.length; j++) {
-        smoothed_data[j] = 0.0
-        var weight = 0.0
-        // TODO: speed could be improved by moving `if` out of loop
-        for (var k=0; k<kernel.length; k++) {
-            var m = j+k-kernel_offset
-            if((m >= 0) && (m < data_in.length)) {
-                var fx = data_in[m]
-                if(fx == fx) {
-                    if (quadrature==true) {
-                        smoothed_data[j] = smoothed_data[j] + (fx * kernel[k])**2
-                    } else {
-                        smoothed_data[j] = smoothed_data[j] + fx * kernel[k]
-                    }
-                    weight += kernel[k]
-                }
-            }
+// Coadd brz spectra. Similar to the python code mycoaddcam(), with linear interpolation
+// in overlap regions : indices and weights are precomputed in python, see plotframes.make_coaddcam_maps()
+// Returns [flux, noise] on the grid coaddcam_spec.data['origwave']
+function coadd_brz_cams(maps, flux_in, noise_in) {
+    var flux_out = new Float64Array(maps.nwave)
+    var noise_out = new Float64Array(maps.nwave)
+    for (var c=0; c<maps.copy.length; c++) { // non-overlapping regions
+        var f = flux_in[maps.copy[c][0]]
+        var n = noise_in[maps.copy[c][0]]
+        var offset = maps.copy[c][1] - maps.copy[c][2]
+        var end_out = maps.copy[c][2] + maps.copy[c][3]
+        for (var i=maps.copy[c][2]; i<end_out; i++) {
+            flux_out[i] = f[i+offset]
+            noise_out[i] = n[i+offset]
         }
-        if (quadrature==true) {
-            smoothed_data[j] = Math.sqrt(smoothed_data[j]) / weight
-        } else {
-            smoothed_data[j] = smoothed_data[j] / weight
+    }
+    for (var j=0; j<maps.over_out.length; j++) { // combine in overlapping regions
+        var f1 = flux_in[maps.over_band1[j]]
+        var n1 = noise_in[maps.over_band1[j]]
+        var k1 = maps.over_index1[j]
+        var w1 = maps.over_frac1[j]
+        var f2 = flux_in[maps.over_band2[j]]
+        var n2 = noise_in[maps.over_band2[j]]
+        var k2 = maps.over_index2[j]
+        var w2 = maps.over_frac2[j]
+        var noise1 = n1[k1] + w1*(n1[k1+1]-n1[k1])
+        var noise2 = n2[k2] + w2*(n2[k2+1]-n2[k2])
+        if ( noise1 > 0 && noise2 > 0 ) {
+            var phi1 = f1[k1] + w1*(f1[k1+1]-f1[k1])
+            var phi2 = f2[k2] + w2*(f2[k2+1]-f2[k2])
+            var iv1 = 1/(noise1*noise1)
+            var iv2 = 1/(noise2*noise2)
+            var iv = iv1+iv2
+            var i = maps.over_out[j]
+            noise_out[i] = 1/Math.sqrt(iv)
+            flux_out[i] = (iv1*phi1+iv2*phi2)/iv
         }
     }
-    return smoothed_data
+    return [flux_out, noise_out]
 }
 
-// Find nearest index in grid, left from point; use dichotomy method
-function index_dichotomy(point, grid) {
-    if ( point < grid[0] ) return 0
-    if ( point > grid[grid.length-1] ) return grid.length-2
-    var i_left = 0
-    var i_center = 0
-    var i_right = grid.length-1
-    while ( i_right - i_left != 1) {
-        i_center = i_left + Math.floor((i_right-i_left)/2)
-        if ( point >= grid[i_center] ) {
-            i_left = i_center
-        } else {
-            i_right = i_center
-        }
+// Compact model : model of spectrum i is computed when first needed
+function build_model(i) {
+    if (model && model_templates && !(('origflux'+i) in model.data)) {
+        var tmpl_data = model_templates[targetinfo.data['model_key'][i]].data
+        model.data['origflux'+i] = template_model(model.data['origwave'], tmpl_data,
+                    targetinfo.data['model_coeff'][i], targetinfo.data['z'][i])
     }
-    return i_left
 }
 
-// Basic linear interpolation at on point
-function interp_grid(xval, xarr, yarr) {
-    var index = index_dichotomy(xval, xarr)
-    var a = (yarr[index+1] - yarr[index])/(xarr[index+1] - xarr[index])
-    var b = yarr[index]-a*xarr[index]
-    var yval = a*xval+b
-    return yval
+// Compact model : rebuild model from template basis vectors, linearly interpolated in log(wave)
+// Same as _template_model() in plotframes.py
+function template_model(model_wave, tmpl_data, coeff, z) {
+    var restwave = tmpl_data['restwave']
+    var nrest = restwave.length
+    var loglam0 = Math.log(restwave[0])
+    var dloglam = Math.log(restwave[nrest-1]/restwave[0]) / (nrest-1)
+    var flux = new Float64Array(model_wave.length)
+    for (var j=0; j<model_wave.length; j++) {
+        var pos = (Math.log(model_wave[j]/(1+z)) - loglam0) / dloglam
+        var k = Math.floor(pos)
+        if (k < 0 || k >= nrest-1) continue
+        var frac = pos - k
+        for (var b=0; b<coeff.length; b++) {
+            var basis = tmpl_data['basis'+b]
+            flux[j] += coeff[b] * (basis[k] + frac*(basis[k+1]-basis[k]))
+        }
+    }
+    return flux
 }
 
-// Coadd brz spectra. Similar to the python code mycoaddcam()
-function coadd_brz_cams(wave_in, flux_in, noise_in) {
-    // each "_in" must have 3 entries (brz)
-    // TODO handle case of no noise
-
-    // Find b,r,z ordering in input arrays
-    var wave_start = [wave_in[0][0], wave_in[1][0], wave_in[2][0]]
-    var i_b = wave_start.indexOf(Math.min.apply(Math, wave_start))
-    var i_z = wave_start.indexOf(Math.max.apply(Math, wave_start))
-    var i_r = 1
-    for (var i=0; i<3; i++) {
-        if ( (i_b != i) && (i_z != i) ) i_r = i
+// Arrays to be smoothed (see smooth_data.js) : flux and noise of each band, then model
+function smoothing_inputs(i) {
+    var inputs = []
+    for (var b=0; b<spectra.length; b++) {
+        var data = spectra[b].data
+        inputs.push([data['origflux'+i], false])
+        if ('plotnoise' in data) {
+            inputs.push([data['orignoise'+i], true]) // Add noise in quadrature
+        }
     }
+    if (model) inputs.push([model.data['origflux'+i], false])
+    return inputs
+}
 
-    var wave_out = []
-    var flux_out = []
-    var noise_out = []
-    var margin = 20
-    for (var i=0; i<wave_in[i_b].length; i++) { // b
-        if (wave_in[i_b][i] < wave_in[i_b][wave_in[i_b].length-1] - margin) {
-            wave_out.push(wave_in[i_b][i])
-            flux_out.push(flux_in[i_b][i])
-            noise_out.push(noise_in[i_b][i])
+// Camera coadd and y-range computed from smoothed arrays (ordered as in smoothing_inputs)
+// Here I choose to do coaddition on the smoothed spectra (should be ok?)
+// Without smoothing, the y-range is taken from statistics precomputed in python (ViewerContext.stats)
+function render_spectrum(smoothed, i, nsmooth) {
+    var use_stats = (nsmooth == 0 && ('flux_ymin' in targetinfo.data))
+    var ymin = 0.0
+    var ymax = 0.0
+    var flux_in = []
+    var noise_in = []
+    var i_smoothed = 0
+    for (var b=0; b<spectra.length; b++) {
+        var data = spectra[b].data
+        var flux = smoothed[i_smoothed++]
+        flux_in.push(flux)
+        if ('plotnoise' in data) {
+            noise_in.push(smoothed[i_smoothed++])
+        } else {
+            noise_in.push(new Float64Array(flux.length).fill(1))
         }
-    }
-    var the_lim = wave_out[wave_out.length-1]
-    for (var i=0; i<wave_in[i_r].length; i++) { // r
-        if ( (wave_in[i_r][i] < wave_in[i_r][wave_in[i_r].length-1] - margin) && (wave_in[i_r][i] > the_lim)) {
-            wave_out.push(wave_in[i_r][i])
-            flux_out.push(flux_in[i_r][i])
-            noise_out.push(noise_in[i_r][i])
+        if (!use_stats) {
+            var tmp = get_y_minmax(0.01, 0.99, flux)
+            ymin = Math.min(ymin, tmp[0])
+            ymax = Math.max(ymax, tmp[1])
         }
     }
-    the_lim = wave_out[wave_out.length-1]
-    for (var i=0; i<wave_in[i_z].length; i++) { // z
-        if (wave_in[i_z][i] > the_lim) {
-            wave_out.push(wave_in[i_z][i])
-            flux_out.push(flux_in[i_z][i])
-            noise_out.push(noise_in[i_z][i])
-        }
+    if (use_stats) {
+        ymin = targetinfo.data['flux_ymin'][i]
+        ymax = targetinfo.data['flux_ymax'][i]
     }
-    for (var i=0; i<wave_out.length; i++) { // combine in overlapping regions
-        var b1 = -1
-        var b2 = -1
-        if ( (wave_out[i] > wave_in[i_r][0]) && (wave_out[i] < wave_in[i_b][wave_in[i_b].length-1]) ) { // br
-            b1 = 0
-            b2 = 1
-        }
-        if ( (wave_out[i] > wave_in[i_z][0]) && (wave_out[i] < wave_in[i_r][wave_in[i_r].length-1]) ) {  // rz
-            b1 = 1
-            b2 = 2
-        }
-        if (b1 != -1) {
-            var phi1 = interp_grid(wave_out[i], wave_in[b1], flux_in[b1])
-            var noise1 = interp_grid(wave_out[i], wave_in[b1], noise_in[b1])
-            var phi2 = interp_grid(wave_out[i], wave_in[b2], flux_in[b2])
-            var noise2 = interp_grid(wave_out[i], wave_in[b2], noise_in[b2])
-            if ( noise1 > 0 && noise2 > 0 ) {
-                var iv1 = 1/(noise1*noise1)
-                var iv2 = 1/(noise2*noise2)
-                var iv = iv1+iv2
-                noise_out[i] = 1/Math.sqrt(iv)
-                flux_out[i] = (iv1*phi1+iv2*phi2)/iv
-            }
+    var coadd = coaddcam_spec ? coadd_brz_cams(coaddcam_maps, flux_in, noise_in) : null
+    return {smoothed: smoothed, coadd: coadd, yrange: [ymin, ymax]}
+}
+
+function smooth_sync(inputs, nsmooth) {
+    if (nsmooth == 0) return inputs.map(function(x) { return x[0].slice() })
+    return inputs.map(function(x) { return smooth_data(x[0], nsmooth, x[1]) })
+}
+
+// Rendered arrays are cached for each (ifiber, nsmooth) : see render_cache.js
+var cache = render_cache(ifiberslider.id, render_cache_size)
+var render_key = ifiber + '_' + nsmooth
+var rendered = cache_get(cache, render_key)
+if (rendered == null) {
+    build_model(ifiber)
+    var smooth_inputs = smoothing_inputs(ifiber)
+    var smoothed = null
+    if (nsmooth != 0 && smoothing_status && smoothing_worker()) {
+        // Smoothing done in a Web Worker : update_plot is called again once it is done
+        if (smoothing_status.smoothed && smoothing_status.smoothed.key == render_key) {
+            smoothed = smoothing_status.smoothed.arrays
+        } else {
+            smooth_in_worker(render_key, smooth_inputs, nsmooth, smoothing_status)
+            return
         }
+    } else {
+        smoothed = smooth_sync(smooth_inputs, nsmooth)
     }
-    return [wave_out, flux_out, noise_out]
+    rendered = render_spectrum(smoothed, ifiber, nsmooth)
+    cache_put(cache, render_key, rendered)
 }
 
-// Smooth plot and recalculate ymin/ymax
-var ymin = 0.0
-var ymax = 0.0
+// Update plots
+var i_smoothed = 0
 for (var i=0; i<spectra.length; i++) {
     var data = spectra[i].data
-    var origflux = data['origflux'+ifiber]
+    data['plotflux'] = rendered.smoothed[i_smoothed++]
     if ('plotnoise' in data) {
-        var orignoise = data['orignoise'+ifiber]
-    }
-    if (nsmooth == 0) {
-        data['plotflux'] = origflux.slice()
-        if ('plotnoise' in data) {
-            data['plotnoise'] = orignoise.slice()
-        }
-    } else {
-        data['plotflux'] = smooth_data(origflux, kernel, kernel_offset)
-        if ('plotnoise' in data) {
-            // Add noise in quadrature
-            data['plotnoise'] = smooth_data(orignoise, kernel, kernel_offset, quadrature=true)
-        }
+        data['plotnoise'] = rendered.smoothed[i_smoothed++]
     }
     spectra[i].change.emit()
-
-    tmp = get_y_minmax(0.01, 0.99, data['plotflux'])
-    ymin = Math.min(ymin, tmp[0])
-    ymax = Math.max(ymax, tmp[1])
 }
 
 // update camera-coadd
-// Here I choose to do coaddition on the smoothed spectra (should be ok?)
 if (coaddcam_spec) {
-    var wave_in = []
-    var flux_in = []
-    var noise_in = []
-    for (var i=0; i<3; i++) {
-        var data = spectra[i].data
-        wave_in.push(data['plotwave'].slice())
-        flux_in.push(data['plotflux'].slice())
-        if ('plotnoise' in data) {
-            noise_in.push(data['plotnoise'].slice())
-        } else {
-            var dummy_noise = []
-            for (var j=0; j<data['plotflux'].length; j++) dummy_noise.push(1)
-            noise_in.push(dummy_noise)
-        }
-    }
-    var coadd_infos = coadd_brz_cams(wave_in, flux_in, noise_in)
-    coaddcam_spec.data['plotwave'] = coadd_infos[0].slice()
-    coaddcam_spec.data['plotflux'] = coadd_infos[1].slice()
-    coaddcam_spec.data['plotnoise'] = coadd_infos[2].slice()
+    coaddcam_spec.data['plotflux'] = rendered.coadd[0]
+    coaddcam_spec.data['plotnoise'] = rendered.coadd[1]
     coaddcam_spec.change.emit()
 }
 
 // update model
 if(model) {
-    var origflux = model.data['origflux'+ifiber]
-    if (nsmooth == 0) {
-        model.data['plotflux'] = origflux.slice()
-    } else {
-        model.data['plotflux'] = smooth_data(origflux, kernel, kernel_offset)
-    }
+    model.data['plotflux'] = rendered.smoothed[i_smoothed++]
     model.change.emit()
 }
 
+// update decimated spectra displayed in the main figure
+if (lod_sources) {
+    update_lod(lod_inputs, lod_sources, lod_keys, waveshift_cds, fig, lod_factors, true)
+}
+
 // update y_range
+var ymin = rendered.yrange[0]
+var ymax = rendered.yrange[1]
 if(ymin<0) {
     fig.y_range.start = ymin * 1.4
 } else {
@@ -279,3 +272,22 @@ if (imfig_source) {
     imfig_source.change.emit()
 }
 
+// Prefetch : the next spectrum is rendered (with the same smoothing) when the browser is idle
+var i_next = ifiber + 1
+var next_key = i_next + '_' + nsmooth
+var next_loaded = true
+if (sidecar) {
+    next_loaded = ((sidecar.fields[0].column+i_next) in sidecar_sources[sidecar.fields[0].source].data)
+}
+if (window.requestIdleCallback && cache.size > 0 && i_next < targetinfo.data['target_info'].length
+        && next_loaded && !(next_key in cache.entries) && cache.prefetching != next_key) {
+    cache.prefetching = next_key
+    window.requestIdleCallback(function() {
+        cache.prefetching = null
+        if (next_key in cache.entries) return
+        build_model(i_next)
+        cache_put(cache, next_key, render_spectrum(smooth_sync(smoothing_inputs(i_next), nsmooth), i_next, nsmooth))
+        // Keep the spectrum currently displayed as most recently used
+        cache_get(cache, render_key)
+    })
+}
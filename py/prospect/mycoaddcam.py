@@ -1,60 +1,214 @@
-
 # EA - Oct 2019 (Temporary / preliminary)
 # desispec.coaddition.coadd_cameras() unsatisfying at least since
 # 1) don't want to coadd over exposures / 2) cannot assume waves are aligned over arms (r/z mismatch seen in datachallenge)
 
+import hashlib
+
 import numpy as np
+import scipy.sparse
 
 from desispec.interpolation import resample_flux
 
+#- Operators already computed, keyed by hash of the wavelength grids
+_coaddcam_operators = dict()
+
+
+class CoaddCamOperator(object):
+    '''
+    Linear operators merging spectra from several cameras into a single (wave,flux),
+    for a given set of wavelength grids.
+      - Outside overlap regions, the merged flux is a copy of one camera's flux.
+      - In overlap regions, each camera's flux is resampled (as desispec resample_flux)
+        onto the merged grid, using a precomputed sparse matrix per camera.
+    Cameras are ordered by their first wavelength; each camera is assumed to overlap
+    at most with the previous and the next ones.
+    '''
+    def __init__(self, waves, bands) :
+        margin = 20 # Angstrom. Avoids using edge-of-band at overlap regions
+        tolerance = 0.0001
+        self.bands = sorted(bands, key=lambda b : waves[b][0])
+        self.waves = { band : waves[band] for band in self.bands }
+        nbands = len(self.bands)
+
+        # Define (arbitrarily) wavelength grid
+        self.copy_in = dict() # indices in each camera's arrays, copied to the merged arrays
+        self.copy_out = dict() # corresponding indices in the merged arrays
+        wave = np.zeros(0)
+        for i, band in enumerate(self.bands) :
+            keep = np.ones(waves[band].size, dtype=bool)
+            if i > 0 : keep &= (waves[band] > wave[-1]+tolerance)
+            if i < nbands-1 : keep &= (waves[band] < np.max(waves[band])-margin)
+            self.copy_in[band], = np.where(keep)
+            self.copy_out[band] = wave.size + np.arange(self.copy_in[band].size)
+            wave = np.append(wave, waves[band][self.copy_in[band]])
+        self.wave = wave
+
+        # Overlapping regions between consecutive cameras
+        w_overlaps = []
+        for b1, b2 in zip(self.bands[:-1], self.bands[1:]) :
+            w_overlap, = np.where( (wave > waves[b2][0]) & (wave < waves[b1][-1]) )
+            w_overlaps.append(w_overlap)
+        self.overlap_out = np.concatenate(w_overlaps) if nbands > 1 else np.zeros(0, dtype=int)
+        n_over = self.overlap_out.size
+
+        # Resampling matrices : (ncamera_wave, n_over) sparse matrix for each camera
+        self.resampling = dict()
+        self.dx_in = dict()
+        self.dx_out = np.zeros(n_over)
+        self.ncameras = np.zeros(n_over)
+        i_over = 0
+        for i, w_overlap in enumerate(w_overlaps) :
+            sl = slice(i_over, i_over+w_overlap.size)
+            self.dx_out[sl] = np.gradient(wave[w_overlap]) if w_overlap.size > 1 else 1
+            self.ncameras[sl] = 2
+            i_over += w_overlap.size
+        for i, band in enumerate(self.bands) :
+            matrix = scipy.sparse.lil_matrix((waves[band].size, n_over))
+            i_over = 0
+            for j, w_overlap in enumerate(w_overlaps) :
+                if j in [i-1, i] and w_overlap.size > 0 :
+                    self._fill_resampling(matrix, waves[band], wave[w_overlap], i_over)
+                i_over += w_overlap.size
+            self.resampling[band] = matrix.tocsr()
+            self.dx_in[band] = np.gradient(waves[band])
+
+    @staticmethod
+    def _fill_resampling(matrix, wave_in, wave_out, i_col) :
+        '''
+        Fills matrix[:, i_col:i_col+wave_out.size] with the operator resampling
+        wave_in => wave_out, computed column by column with unit vectors.
+        Only input pixels close enough to wave_out contribute.
+        '''
+        if wave_out.size > 1 :
+            dw_lo, dw_hi = wave_out[1]-wave_out[0], wave_out[-1]-wave_out[-2]
+        else :
+            dw_lo = dw_hi = np.max(np.diff(wave_in))
+        w_in, = np.where( (wave_in > wave_out[0]-dw_lo) & (wave_in < wave_out[-1]+dw_hi) )
+        w_in = np.arange(max(0, w_in[0]-2), min(wave_in.size, w_in[-1]+3)) if w_in.size > 0 else w_in
+        unit = np.zeros(wave_in.size)
+        for k in w_in :
+            unit[k] = 1
+            column = resample_flux(wave_out, wave_in, unit)
+            unit[k] = 0
+            nonzero, = np.where(column != 0)
+            for l in nonzero :
+                matrix[k, i_col+l] = column[l]
+
+    def linear_maps(self) :
+        '''
+        Maps used to merge cameras in javascript (coadd_brz_cams() in update_plot.js), where
+        the flux and noise of both cameras are linearly interpolated in overlap regions.
+        Returns a dict with :
+          - copy : list of (band, first index in camera, first index in self.wave, number of pixels)
+          - over_out : indices of overlap pixels in self.wave
+          - over_band<k>, over_index<k>, over_frac<k> (k=1,2) : for each overlap pixel, camera k
+            is interpolated as x[index] + frac * (x[index+1]-x[index]) (extrapolated at edges)
+        '''
+        maps = dict(copy=[])
+        for band in self.bands :
+            copy_in = self.copy_in[band]
+            if copy_in.size == 0 : continue
+            assert np.all(np.diff(copy_in) == 1)
+            maps['copy'].append( (band, int(copy_in[0]), int(self.copy_out[band][0]), int(copy_in.size)) )
+
+        maps['over_out'] = self.overlap_out
+        for k in [1, 2] :
+            maps['over_band'+str(k)] = []
+            maps['over_index'+str(k)] = np.zeros(self.overlap_out.size, dtype=np.int32)
+            maps['over_frac'+str(k)] = np.zeros(self.overlap_out.size)
+        i_over = 0
+        for b1, b2 in zip(self.bands[:-1], self.bands[1:]) :
+            w_overlap, = np.where( (self.wave > self.waves[b2][0]) & (self.wave < self.waves[b1][-1]) )
+            sl = slice(i_over, i_over+w_overlap.size)
+            for k, band in [(1, b1), (2, b2)] :
+                wave_in = self.waves[band]
+                index = np.searchsorted(wave_in, self.wave[w_overlap], side='right') - 1
+                index = np.clip(index, 0, wave_in.size-2)
+                maps['over_band'+str(k)] += [band] * w_overlap.size
+                maps['over_index'+str(k)][sl] = index
+                maps['over_frac'+str(k)][sl] = (self.wave[w_overlap]-wave_in[index]) / (wave_in[index+1]-wave_in[index])
+            i_over += w_overlap.size
+
+        return maps
+
+    def apply(self, fluxes, ivars) :
+        '''
+        Merges cameras for a block of spectra
+        fluxes, ivars : dicts { band : 2D[nspec, ncamera_wave] array }
+        Returns (flux, ivar), 2D[nspec, nwave] arrays on the merged grid self.wave
+        In overlap regions the merged flux is the ivar-weighted mean of the resampled
+        fluxes (or their mean if all ivars are zero), and ivars are summed.
+        '''
+        band0 = self.bands[0]
+        nspec = fluxes[band0].shape[0]
+        flux = np.zeros((nspec, self.wave.size), dtype=fluxes[band0].dtype)
+        ivar = np.zeros((nspec, self.wave.size), dtype=ivars[band0].dtype)
+
+        # Flux in non-overlapping waves
+        for band in self.bands :
+            flux[:, self.copy_out[band]] = fluxes[band][:, self.copy_in[band]]
+            ivar[:, self.copy_out[band]] = ivars[band][:, self.copy_in[band]]
+
+        # Overlapping regions : same as resample_flux(..., ivar=...), for all spectra at once
+        if self.overlap_out.size == 0 : return (flux, ivar)
+        n_over = self.overlap_out.size
+        sum_ivar = np.zeros((nspec, n_over))
+        sum_weighted_phi = np.zeros((nspec, n_over))
+        sum_phi = np.zeros((nspec, n_over))
+        for band in self.bands :
+            matrix = self.resampling[band]
+            if matrix.nnz == 0 : continue
+            band_flux = np.asarray(fluxes[band], dtype=np.float64)
+            band_ivar = np.asarray(ivars[band], dtype=np.float64)
+            a = np.asarray(band_flux*band_ivar @ matrix)
+            b = np.asarray(band_ivar @ matrix)
+            phi = np.zeros(a.shape)
+            w = (b > 0)
+            phi[w] = a[w] / b[w]
+            phi_ivar = np.asarray((band_ivar/self.dx_in[band]) @ matrix) * self.dx_out
+            sum_ivar += phi_ivar
+            sum_weighted_phi += phi_ivar*phi
+            sum_phi += phi
+        over_flux = sum_phi / self.ncameras
+        w_ok = (sum_ivar > 0)
+        over_flux[w_ok] = sum_weighted_phi[w_ok] / sum_ivar[w_ok]
+        flux[:, self.overlap_out] = over_flux
+        ivar[:, self.overlap_out] = sum_ivar
+
+        return (flux, ivar)
+
+
+def _waves_hash(waves, bands) :
+    '''
+    Hash identifying a set of wavelength grids
+    '''
+    h = hashlib.sha1()
+    for band in sorted(bands) :
+        h.update(band.encode('utf-8'))
+        h.update(np.ascontiguousarray(waves[band], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def get_coaddcam_operator(waves, bands=None) :
+    '''
+    Returns CoaddCamOperator for the wavelength grids { band : wave },
+    computed only once per set of grids.
+    '''
+    if bands is None : bands = list(waves.keys())
+    key = _waves_hash(waves, bands)
+    if key not in _coaddcam_operators :
+        _coaddcam_operators[key] = CoaddCamOperator(waves, bands)
+    return _coaddcam_operators[key]
+
+
 def mycoaddcam(spectra) :
     """"
-    Merges brz spectra into a single (wave,flux)
-      takes into account noise and mis-matched wavelengths over the 3 arms
-    Currently assumes b r z bands and two overlap regions
+    Merges spectra from all cameras (eg. brz) into a single (wave,flux)
+      takes into account noise and mis-matched wavelengths over the arms
+    The merging operator is computed once per set of wavelength grids, see CoaddCamOperator
     """
-    
-    assert np.all([ band in spectra.wave.keys() for band in ['b','r','z'] ]) 
-    
-    # Define (arbitrarily) wavelength grid
-    margin = 20 # Angstrom. Avoids using edge-of-band at overlap regions
-    wave = spectra.wave['b'].copy()
-    wave = wave[ (wave<np.max(wave)-margin) ]
-    tolerance = 0.0001
-    length_bands = {'b' : wave.size}
-    w_bands = {'b' : np.arange(wave.size)}
-    for band in ['r','z'] :
-        if band=='z' : w_bands[band], = np.where( spectra.wave[band]>wave[-1]+tolerance )
-        else : w_bands[band], = np.where( (spectra.wave[band]>wave[-1]+tolerance)
-                                  & (spectra.wave[band]<np.max(spectra.wave[band])-margin) )
-        wave=np.append(wave,spectra.wave[band][w_bands[band]])
-        length_bands[band] = w_bands[band].size
-    
-    nwave = wave.size
-    nspec = spectra.num_spectra()
-    flux = np.zeros((nspec,nwave),dtype=spectra.flux['b'].dtype)
-    ivar = np.zeros((nspec,nwave),dtype=spectra.ivar['b'].dtype)
-    
-    # Flux in non-overlapping waves
-    i = 0
-    for band in ['b', 'r', 'z'] :
-        flux[:,i:i+length_bands[band]] = spectra.flux[band][:,w_bands[band]]
-        ivar[:,i:i+length_bands[band]] = spectra.ivar[band][:,w_bands[band]]
-        i += length_bands[band]
-    
-    # Overlapping regions
-    overlaps = ['br','rz']
-    for the_overlap in overlaps :
-        b1, b2 = the_overlap[0], the_overlap[1]
-        w_overlap, = np.where( (wave > spectra.wave[b2][0]) & (wave < spectra.wave[b1][-1]) )
-        assert (w_overlap.size > 0)
-        lambd_over = wave[w_overlap]
-        for ispec in range(nspec) :
-            phi1, ivar1 = resample_flux(lambd_over, spectra.wave[b1], spectra.flux[b1][ispec,:], ivar=spectra.ivar[b1][ispec,:])
-            phi2, ivar2 = resample_flux(lambd_over, spectra.wave[b2], spectra.flux[b2][ispec,:], ivar=spectra.ivar[b2][ispec,:])
-            ivar[ispec,w_overlap] = ivar1+ivar2
-            w_ok = np.where( ivar[ispec,w_overlap] > 0)
-            flux[ispec,w_overlap] = (phi1+phi2)/2
-            flux[ispec,w_overlap][w_ok] = (ivar1[w_ok]*phi1[w_ok] + ivar2[w_ok]*phi2[w_ok])/ivar[ispec,w_overlap][w_ok]
-    
-    return (wave, flux, ivar)
+
+    operator = get_coaddcam_operator(spectra.wave, spectra.bands)
+    flux, ivar = operator.apply(spectra.flux, spectra.ivar)
+
+    return (operator.wave.copy(), flux, ivar)
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized tools to compute model spectra from redrock outputs
+
+All functions here act on blocks of spectra [nspec, nwave] at once,
+instead of looping over individual targets.
+ModelStore keeps computed models, in memory or on disk, to avoid computing them twice.
+"""
+
+import os
+import hashlib
+
+import numpy as np
+
+from desiutil.log import get_logger
+
+
+def _bin_edges(wave) :
+    '''
+    Edges of the bins centered on wave[nwave], as in desispec.interpolation.resample_flux
+    '''
+    edges = np.zeros(wave.size+1)
+    edges[1:-1] = (wave[:-1]+wave[1:])/2.
+    edges[0] = 1.5*wave[0]-0.5*wave[1]
+    edges[-1] = 1.5*wave[-1]-0.5*wave[-2]
+    return edges
+
+
+def _cumulative_integral(wave, flux) :
+    '''
+    Cumulative integral of the piecewise-linear functions flux[nspec, nwave] defined on wave[nwave]
+    Input functions are extended with zeros over one extra bin on each side,
+    as done by desispec.interpolation.resample_flux when extrapolate=False.
+
+    Returns (xnodes[nwave+2], fnodes[nspec, nwave+2], cumint[nspec, nwave+2])
+    '''
+    nspec = flux.shape[0]
+    xnodes = np.concatenate( ( [2*wave[0]-wave[1]], wave, [2*wave[-1]-wave[-2]] ) )
+    fnodes = np.zeros((nspec, xnodes.size))
+    fnodes[:,1:-1] = flux
+    cumint = np.zeros((nspec, xnodes.size))
+    cumint[:,1:] = np.cumsum( 0.5*(fnodes[:,1:]+fnodes[:,:-1])*np.diff(xnodes), axis=1 )
+    return xnodes, fnodes, cumint
+
+
+def _eval_cumulative(xnodes, fnodes, cumint, x, k) :
+    '''
+    Evaluates cumulative integrals (from _cumulative_integral) at positions x[nspec, npts],
+    knowing that xnodes[k] <= x < xnodes[k+1]. Outside xnodes, the integral is constant.
+    '''
+    k = np.clip(k, 0, xnodes.size-2)
+    dx = np.diff(xnodes)[k]
+    d = np.clip(x - xnodes[k], 0, dx)
+    f0 = np.take_along_axis(fnodes, k, axis=1)
+    f1 = np.take_along_axis(fnodes, k+1, axis=1)
+    c0 = np.take_along_axis(cumint, k, axis=1)
+    return c0 + d*(f0 + 0.5*(f1-f0)*d/dx)
+
+
+def resample_redshifted(outwave, restwave, restflux, z) :
+    '''
+    Redshifts and resamples a block of rest-frame spectra onto a common output grid
+
+    outwave : 1D[nout] output wavelength grid
+    restwave : 1D[nrest] rest-frame wavelength grid
+    restflux : 2D[nspec, nrest] rest-frame flux densities
+    z : 1D[nspec] redshifts
+
+    Returns 2D[nspec, nout] array. Row i is identical to
+        desispec.interpolation.resample_flux(outwave, restwave*(1+z[i]), restflux[i])
+    ie. flux-conserving integration of the piecewise-linear input over the output bins.
+    '''
+    z = np.atleast_1d(z)
+    xnodes, fnodes, cumint = _cumulative_integral(restwave, restflux)
+    edges = _bin_edges(outwave)
+    #- Bin edges, in the rest-frame of each spectrum
+    restedges = edges[np.newaxis,:] / (1+z[:,np.newaxis])
+    k = np.searchsorted(xnodes, restedges, side='right') - 1
+    integ = _eval_cumulative(xnodes, fnodes, cumint, restedges, k)
+    #- Integral of observed-frame flux = (1+z) * integral in rest frame
+    return (1+z[:,np.newaxis]) * np.diff(integ, axis=1) / np.diff(edges)
+
+
+def apply_resolution(rdata, flux) :
+    '''
+    Convolves a block of spectra by their resolution matrices, without building
+    any desispec.resolution.Resolution (sparse) object
+
+    rdata : 3D[nspec, ndiag, nwave] resolution diagonals (as in spectra.resolution_data[band])
+    flux : 2D[nspec, nwave]
+
+    Returns 2D[nspec, nwave] array. Row i is identical to Resolution(rdata[i]).dot(flux[i])
+    Diagonal d of rdata corresponds to offset ndiag//2-d, as in desispec.resolution.
+    '''
+    nspec, ndiag, nwave = rdata.shape
+    assert flux.shape == (nspec, nwave)
+    out = np.zeros((nspec, nwave))
+    for d in range(ndiag) :
+        offset = ndiag//2 - d
+        if offset >= 0 :
+            out[:,0:nwave-offset] += rdata[:,d,offset:] * flux[:,offset:]
+        else :
+            out[:,-offset:] += rdata[:,d,0:nwave+offset] * flux[:,0:nwave+offset]
+    return out
+
+
+class LogLamBasis(object):
+    '''
+    Template basis vectors tabulated once on a uniform ln(wave) grid, together
+    with their cumulative integrals.
+
+    On such a grid, redshifting is a constant shift by ln(1+z)/dloglam pixels:
+    output bin edges are located by index arithmetic instead of an interpolation
+    search, and since the integration is linear in the basis vectors, models
+    are integrated over the output bins without building them at full resolution.
+    '''
+    def __init__(self, wave, flux, dloglam=2e-5) :
+        '''
+        wave : 1D[nwave] wavelength grid of the basis
+        flux : 2D[nbasis, nwave] basis vectors
+        dloglam : step in ln(wave) used if wave is not already uniform in ln(wave)
+            Native step is kept if smaller than dloglam.
+        '''
+        logwave = np.log(wave)
+        step = np.diff(logwave)
+        if np.allclose(step, step[0], rtol=1.e-6, atol=0) :
+            #- Basis is already on a log-lambda grid
+            loglam = logwave
+            self.dloglam = (logwave[-1]-logwave[0])/(logwave.size-1)
+            logflux = np.asarray(flux, dtype=np.float64)
+        else :
+            self.dloglam = min(dloglam, np.min(step))
+            nlog = int(np.ceil((logwave[-1]-logwave[0])/self.dloglam)) + 1
+            loglam = logwave[0] + self.dloglam*np.arange(nlog)
+            logflux = np.array([ np.interp(np.exp(loglam), wave, f) for f in flux ])
+        self.loglam0 = loglam[0]
+        self.wave = np.exp(loglam)
+        self.xnodes, self.fnodes, self.cumint = _cumulative_integral(self.wave, logflux)
+
+    @property
+    def nbasis(self) :
+        return self.fnodes.shape[0]
+
+    def models(self, outwave, coeff, z) :
+        '''
+        Computes redshifted models for a block of targets
+
+        outwave : 1D[nout] output wavelength grid
+        coeff : 2D[nspec, nbasis] coefficients of the basis vectors
+        z : 1D[nspec] redshifts
+
+        Returns 2D[nspec, nout] array of flux-conserving, resampled models,
+        as resample_redshifted(outwave, self.wave, coeff.dot(basis), z)
+        '''
+        z = np.atleast_1d(z)
+        coeff = np.atleast_2d(coeff)
+        edges = _bin_edges(outwave)
+        restedges = edges[np.newaxis,:] / (1+z[:,np.newaxis])
+        #- Index shift : xnodes[k+1] = exp(loglam0 + k*dloglam)
+        pos = (np.log(edges)[np.newaxis,:] - np.log1p(z)[:,np.newaxis] - self.loglam0) / self.dloglam
+        k = np.clip(np.floor(pos).astype(int) + 1, 0, self.xnodes.size-2)
+        dx = np.diff(self.xnodes)[k]
+        d = np.clip(restedges - self.xnodes[k], 0, dx)
+        integ = np.zeros(restedges.shape)
+        for ibasis in range(self.nbasis) :
+            f0 = self.fnodes[ibasis][k]
+            f1 = self.fnodes[ibasis][k+1]
+            c0 = self.cumint[ibasis][k]
+            integ += coeff[:,ibasis,np.newaxis] * (c0 + d*(f0 + 0.5*(f1-f0)*d/dx))
+        return (1+z[:,np.newaxis]) * np.diff(integ, axis=1) / np.diff(edges)
+
+
+def _file_hash(filename, blocksize=2**20) :
+    '''
+    sha1 hash of a file's content
+    '''
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f :
+        for block in iter(lambda: f.read(blocksize), b'') :
+            h.update(block)
+    return h.hexdigest()
+
+
+class ModelStore(object):
+    '''
+    Store of model spectra computed from a zbest file, so that each model is
+    computed at most once, by whichever consumer (plotspectra, miniplot_spectrum...)
+    needs it first.
+
+    Models are keyed by fibermap columns (TARGETID by default). If filename is set,
+    the store is persistent : it is saved as a npz file, tagged by a hash of the
+    zbest file and of the redrock templates, and reused by later production runs
+    as long as neither the zbest file nor the templates changed. The store is written
+    only by save(), which should be called once all models are computed (eg. once per pixel).
+    '''
+    def __init__(self, filename=None, zbest_file=None, key_columns=('TARGETID',)) :
+        '''
+        filename : npz file where models are stored; if None, the store is kept in memory only
+        zbest_file : zbest file from which models are computed (required if filename is set)
+        key_columns : fibermap columns identifying a model, eg. ('TARGETID', 'EXPID')
+            for single-exposure spectra
+        '''
+        self.filename = filename
+        self.key_columns = list(key_columns)
+        self.tag = None
+        if filename is not None :
+            from prospect import mytemplates
+            if zbest_file is None : raise RuntimeError("A persistent ModelStore requires zbest_file")
+            self.tag = _file_hash(zbest_file)+'-'+mytemplates.templates_hash()
+        self._reset()
+        self._loaded = False
+
+    def _reset(self) :
+        self._index = dict()
+        self._wave = None
+        #- Models are stored in a list of blocks, concatenated only when saving
+        #- (so that adding models page by page does not copy all stored models each time)
+        self._blocks = []
+        self._offsets = []
+        self._nstored = 0
+
+    def _append_block(self, flux) :
+        self._blocks.append(flux)
+        self._offsets.append(self._nstored)
+        self._nstored += flux.shape[0]
+
+    def _rows(self, rows) :
+        '''
+        Stored models for a list of rows, gathered from the stored blocks
+        '''
+        rows = np.asarray(rows, dtype=int)
+        flux = np.zeros((rows.size, self._wave.size))
+        iblock = np.searchsorted(self._offsets, rows, side='right') - 1
+        for i in np.unique(iblock) :
+            w = (iblock == i)
+            flux[w] = self._blocks[i][rows[w]-self._offsets[i]]
+        return flux
+
+    def _load(self) :
+        '''
+        Reads stored models, if any, and if their tag is up to date
+        '''
+        log = get_logger()
+        self._loaded = True
+        if self.filename is None or not os.path.isfile(self.filename) : return
+        with np.load(self.filename) as data :
+            if str(data['tag']) != self.tag :
+                log.info("Model store "+self.filename+" is outdated : models will be recomputed")
+                return
+            keys = zip(*[ data['key_'+col].tolist() for col in self.key_columns ])
+            self._index = { k : i for i, k in enumerate(keys) }
+            self._wave = data['wave']
+            self._append_block(data['flux'])
+
+    def save(self) :
+        '''
+        Writes the store to its npz file (atomic replacement)
+        '''
+        if self.filename is None or self._wave is None : return
+        if len(self._blocks) > 1 :
+            flux = np.concatenate(self._blocks)
+            self._blocks = []
+            self._offsets = []
+            self._nstored = 0
+            self._append_block(flux)
+        keys = sorted(self._index, key=self._index.get)
+        data = dict(tag=self.tag, wave=self._wave, flux=self._blocks[0])
+        for i, col in enumerate(self.key_columns) :
+            data['key_'+col] = np.array([ k[i] for k in keys ])
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(dirname) : os.makedirs(dirname)
+        tmpfile = self.filename+'.tmp'+str(os.getpid())+'.npz'
+        np.savez(tmpfile, **data)
+        os.rename(tmpfile, self.filename)
+
+    def _spectra_keys(self, spectra) :
+        return list(zip(*[ spectra.fibermap[col].tolist() for col in self.key_columns ]))
+
+    def _add(self, keys, wave, flux) :
+        log = get_logger()
+        if self._wave is not None and not np.array_equal(wave, self._wave) :
+            log.warning("Model store : wavelength grid changed, previous models discarded")
+            self._reset()
+        if self._wave is None :
+            self._wave = wave
+        for i, k in enumerate(keys) :
+            self._index[k] = self._nstored+i
+        self._append_block(flux.astype(np.float32))
+
+    def get_models(self, spectra, zcatalog) :
+        '''
+        Returns (model_wave, model_flux), model_flux being row-matched to spectra.
+        zcatalog must be row-matched to spectra (see utils_specviewer.match_zcat_to_spectra).
+        Models not yet in the store are computed with plotframes.create_model, then stored
+        (in memory : use save() to write them to disk).
+        '''
+        from prospect import plotframes
+        from prospect import myspecselect
+
+        if not self._loaded : self._load()
+        assert np.all(np.asarray(zcatalog['TARGETID']) == np.asarray(spectra.fibermap['TARGETID']))
+        keys = self._spectra_keys(spectra)
+        missing = [ i for i, k in enumerate(keys) if k not in self._index ]
+        if len(missing) > 0 :
+            if len(missing) < spectra.num_spectra() :
+                subspectra = myspecselect.myspecselect(spectra, indices=missing, view=True)
+            else :
+                subspectra = spectra
+            mwave, mflux = plotframes.create_model(subspectra, zcatalog[missing])
+            self._add([ keys[i] for i in missing ], mwave, mflux)
+        rows = [ self._index[k] for k in keys ]
+        return self._wave.copy(), self._rows(rows)
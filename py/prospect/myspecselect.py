@@ -2,10 +2,136 @@
 # EA - June 2019. TEMPORARY modification to desi spectra.select() function
 # to include expid-based selection + indices-based selection
 # changes : fct name+args ; self=>thespec ; expid/indices-based selection + final selection
+# + vectorized selection, and "view" mode (SpectraView) avoiding to copy spectral arrays
 
+import numpy as np
 import desispec.spectra
 
-def myspecselect(thespec, nights=None, bands=None, targets=None, fibers=None, expids=None, indices=None, invert=False):
+
+class _LazyBandDict(dict):
+    '''
+    { band : parent_array[index] }, each band's array being extracted at first access only
+    '''
+    def __init__(self, parent_dict, bands, index) :
+        super(_LazyBandDict, self).__init__()
+        self._parent_dict = parent_dict
+        self._bands = list(bands)
+        self._index = index
+
+    def __missing__(self, band) :
+        if band not in self._bands :
+            raise KeyError(band)
+        self[band] = self._parent_dict[band][self._index]
+        return dict.__getitem__(self, band)
+
+    def __contains__(self, band) :
+        return band in self._bands
+
+    def __iter__(self) :
+        return iter(self._bands)
+
+    def __len__(self) :
+        return len(self._bands)
+
+    def keys(self) :
+        return list(self._bands)
+
+    def values(self) :
+        return [ self[b] for b in self._bands ]
+
+    def items(self) :
+        return [ (b, self[b]) for b in self._bands ]
+
+    def get(self, band, default=None) :
+        return self[band] if band in self._bands else default
+
+
+class SpectraView(object):
+    '''
+    Subset of a Spectra object, defined by a list of row indices in the parent object.
+    Spectral arrays (flux, ivar, mask, resolution_data, extra) are not copied :
+    each band is extracted from the parent's arrays at first access only.
+    Implements the part of the desispec.spectra.Spectra interface used in prospect;
+    use materialize() to get an actual Spectra object.
+    '''
+    def __init__(self, parent, index, bands=None) :
+        index = np.asarray(index, dtype=np.int64)
+        if bands is None : bands = parent.bands
+        if isinstance(parent, SpectraView) :
+            index = parent.parent_index[index]
+            parent = parent.parent
+        self.parent = parent
+        self.parent_index = index
+        self.bands = list(bands)
+        self.wave = { b : parent.wave[b] for b in self.bands }
+        self.flux = _LazyBandDict(parent.flux, self.bands, index)
+        self.ivar = _LazyBandDict(parent.ivar, self.bands, index)
+        self.mask = None
+        if parent.mask is not None :
+            self.mask = _LazyBandDict(parent.mask, self.bands, index)
+        self.resolution_data = None
+        if parent.resolution_data is not None :
+            self.resolution_data = _LazyBandDict(parent.resolution_data, self.bands, index)
+        self.extra = None
+        if parent.extra is not None :
+            self.extra = { b : _LazyBandDict(parent.extra[b], list(parent.extra[b].keys()), index)
+                           for b in self.bands }
+        self.fibermap = parent.fibermap[index]
+        self.scores = None
+        if parent.scores is not None : self.scores = parent.scores[index]
+        self.meta = parent.meta
+        self._single = parent._single
+        self._R = None
+
+    @property
+    def R(self) :
+        '''
+        Resolution matrices { band : [Resolution] }, as in desispec.spectra.Spectra
+        '''
+        if self._R is None and self.resolution_data is not None :
+            from desispec.resolution import Resolution
+            self._R = { b : np.array([ Resolution(r) for r in self.resolution_data[b] ])
+                        for b in self.bands }
+        return self._R
+
+    def num_spectra(self) :
+        return len(self.parent_index)
+
+    def num_targets(self) :
+        return len(self.target_ids())
+
+    def target_ids(self) :
+        '''
+        Unique TARGETIDs, in order of first appearance (as desispec.spectra.Spectra.target_ids)
+        '''
+        targetids = np.asarray(self.fibermap['TARGETID'])
+        dummy, i_first = np.unique(targetids, return_index=True)
+        return targetids[np.sort(i_first)]
+
+    def materialize(self) :
+        '''
+        Returns a desispec.spectra.Spectra object, with copies of the selected data
+        '''
+        extra = None
+        if self.extra is not None :
+            extra = { b : dict(self.extra[b].items()) for b in self.bands }
+        return desispec.spectra.Spectra(self.bands, dict(self.wave),
+            dict(self.flux.items()), dict(self.ivar.items()),
+            mask=(None if self.mask is None else dict(self.mask.items())),
+            resolution_data=(None if self.resolution_data is None else dict(self.resolution_data.items())),
+            fibermap=self.fibermap, meta=self.meta, extra=extra,
+            single=self._single, scores=self.scores)
+
+
+def _select_rows(column, values) :
+    '''
+    Boolean mask of rows of column whose value is in values (a scalar is accepted)
+    '''
+    return np.isin(np.asarray(column), np.atleast_1d(values))
+
+
+def myspecselect(thespec, nights=None, bands=None, targets=None, fibers=None, expids=None, indices=None, invert=False,
+                 view=False):
     """
     Select a subset of the data.
     This filters the data based on a logical AND of the different
@@ -18,97 +144,46 @@ def myspecselect(thespec, nights=None, bands=None, targets=None, fibers=None, ex
         ADDED=> expids (list): list/array of individual exposures to select.      
         ADDED =>indices (list) : list of raw (arbitrary) indices in the Spectra object to select. 
         invert (bool): after combining all criteria, invert selection.
-    Returns (Spectra):
+        ADDED => view (bool): if True, return a SpectraView (no copy of spectral arrays).
+    thespec can be either a Spectra or a SpectraView object.
+    Selected spectra are kept in the order of thespec (whatever the order of indices).
+    Returns (Spectra or SpectraView):
         a new Spectra object containing the selected data.
     """
-    keep_bands = None
     if bands is None:
-        keep_bands = thespec.bands
+        keep_bands = list(thespec.bands)
     else:
         keep_bands = [ x for x in thespec.bands if x in bands ]
     if len(keep_bands) == 0:
         raise RuntimeError("no valid bands were selected!")
 
-    keep_nights = None
-    if nights is None:
-        keep_nights = [ True for x in range(thespec.num_spectra()) ]
-    else:
-        keep_nights = [ (x in nights) for x in thespec.fibermap["NIGHT"] ]
-    if sum(keep_nights) == 0:
-        raise RuntimeError("no valid nights were selected!")
-
-    keep_targets = None
-    if targets is None:
-        keep_targets = [ True for x in range(thespec.num_spectra()) ]
-    else:
-        keep_targets = [ (x in targets) for x in thespec.fibermap["TARGETID"] ]
-    if sum(keep_targets) == 0:
-        raise RuntimeError("no valid targets were selected!")
-
-    keep_fibers = None
-    if fibers is None:
-        keep_fibers = [ True for x in range(thespec.num_spectra()) ]
-    else:
-        keep_fibers = [ (x in fibers) for x in thespec.fibermap["FIBER"] ]
-    if sum(keep_fibers) == 0:
-        raise RuntimeError("no valid fibers were selected!")
+    nspec = thespec.num_spectra()
+    keep_rows = np.ones(nspec, dtype=bool)
+    for values, colname, label in [ (nights, "NIGHT", "nights"), (targets, "TARGETID", "targets"),
+                                    (fibers, "FIBER", "fibers"), (expids, "EXPID", "expids") ] :
+        if values is None : continue
+        keep_col = _select_rows(thespec.fibermap[colname], values)
+        if not np.any(keep_col):
+            raise RuntimeError("no valid "+label+" were selected!")
+        keep_rows &= keep_col
 
-    keep_expids = None
-    if expids is None:
-        keep_expids = [ True for x in range(thespec.num_spectra()) ]
-    else:
-        keep_expids = [ (x in expids) for x in thespec.fibermap["EXPID"] ]
-    if sum(keep_expids) == 0:
-        raise RuntimeError("no valid expids were selected!")
-
-    keep_indices = None
-    if indices is None:
-        keep_indices = [ True for x in range(thespec.num_spectra()) ]
-    else:
-        keep_indices = [ (x in indices) for x in range(thespec.num_spectra()) ]
-    if sum(keep_indices) == 0:
-        raise RuntimeError("no valid indices were selected!")
+    if indices is not None:
+        keep_indices = np.zeros(nspec, dtype=bool)
+        indices = np.atleast_1d(indices)
+        keep_indices[indices[(indices>=0) & (indices<nspec)]] = True
+        if not np.any(keep_indices):
+            raise RuntimeError("no valid indices were selected!")
+        keep_rows &= keep_indices
 
-    keep_rows = [ (x and y and z and t and u) for x, y, z, t, u in zip(keep_nights, keep_targets, keep_fibers, keep_expids, keep_indices) ]
     if invert:
-        keep_rows = [ not x for x in keep_rows ]
+        keep_rows = ~keep_rows
 
-    keep = [ i for i, x in enumerate(keep_rows) if x ]
+    keep, = np.where(keep_rows)
     if len(keep) == 0:
         raise RuntimeError("selection has no spectra")
 
-    keep_wave = {}
-    keep_flux = {}
-    keep_ivar = {}
-    keep_mask = None
-    keep_res = None
-    keep_extra = None
-    if thespec.mask is not None:
-        keep_mask = {}
-    if thespec.resolution_data is not None:
-        keep_res = {}
-    if thespec.extra is not None:
-        keep_extra = {}
-
-    for b in keep_bands:
-        keep_wave[b] = thespec.wave[b]
-        keep_flux[b] = thespec.flux[b][keep,:]
-        keep_ivar[b] = thespec.ivar[b][keep,:]
-        if thespec.mask is not None:
-            keep_mask[b] = thespec.mask[b][keep,:]
-        if thespec.resolution_data is not None:
-            keep_res[b] = thespec.resolution_data[b][keep,:,:]
-        if thespec.extra is not None:
-            keep_extra[b] = {}
-            for ex in thespec.extra[b].items():
-                keep_extra[b][ex[0]] = ex[1][keep,:]
-
-    keep_scores = None
-    if thespec.scores is not None : keep_scores = thespec.scores[keep]
-    
-    ret = desispec.spectra.Spectra(keep_bands, keep_wave, keep_flux, keep_ivar, 
-        mask=keep_mask, resolution_data=keep_res, 
-        fibermap=thespec.fibermap[keep], meta=thespec.meta, extra=keep_extra,
-        single=thespec._single, scores=keep_scores)
+    ret = SpectraView(thespec, keep, bands=keep_bands)
+    if not view :
+        ret = ret.materialize()
 
     return ret
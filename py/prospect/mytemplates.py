@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry of redrock templates used by prospect to compute model spectra
+
+Each template file is parsed at most once per process. A compact copy of each
+template (npy arrays, read back as memmaps) is also kept on disk, keyed by the
+template file path and mtime, so that new worker processes don't need to
+re-parse the FITS templates.
+The cache directory is $PROSPECT_TEMPLATE_CACHE, or ~/.cache/prospect/templates
+"""
+
+import os, sys
+import json
+import hashlib
+import shutil
+
+import numpy as np
+
+from desiutil.log import get_logger
+from prospect import mymodels
+
+#- Process-wide registry : { (filename, mtime) : RRTemplate }
+_template_registry = dict()
+
+
+class RRTemplate(object):
+    '''
+    Light-weight, read-only equivalent of redrock.templates.Template
+    Only holds what is needed to compute model spectra from zbest coefficients.
+    '''
+    def __init__(self, template_type, sub_type, wave, flux, filename=None) :
+        self.template_type = template_type
+        self.sub_type = sub_type
+        self.wave = wave
+        self.flux = flux
+        self.filename = filename
+        self._loglam_basis = None
+
+    @property
+    def nbasis(self) :
+        return self.flux.shape[0]
+
+    @property
+    def nwave(self) :
+        return self.wave.size
+
+    def loglam_basis(self) :
+        '''
+        Returns the basis pre-tabulated on a log-lambda grid (mymodels.LogLamBasis),
+        computed at first call only
+        '''
+        if self._loglam_basis is None :
+            self._loglam_basis = mymodels.LogLamBasis(self.wave, self.flux)
+        return self._loglam_basis
+
+
+def template_cache_dir() :
+    '''
+    Returns the base directory of the on-disk template cache
+    '''
+    if 'PROSPECT_TEMPLATE_CACHE' in os.environ :
+        return os.environ['PROSPECT_TEMPLATE_CACHE']
+    return os.path.join(os.path.expanduser('~'), '.cache', 'prospect', 'templates')
+
+
+def _cache_key(filename) :
+    '''
+    Cache key of a template file, from its absolute path and mtime
+    '''
+    filename = os.path.abspath(filename)
+    mtime = os.path.getmtime(filename)
+    txt = '{}:{!r}'.format(filename, mtime)
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+
+def _parse_template(filename) :
+    '''
+    Reads a template FITS file with redrock; redirect stdout because redrock is chatty
+    '''
+    import redrock.templates
+
+    saved_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        tx = redrock.templates.Template(filename)
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved_stdout
+
+    return RRTemplate(tx.template_type, tx.sub_type,
+                      np.asarray(tx.wave, dtype=np.float64),
+                      np.asarray(tx.flux, dtype=np.float64), filename=filename)
+
+
+def _read_disk_cache(cachedir, filename) :
+    '''
+    Returns cached RRTemplate from cachedir, or None if not available
+    '''
+    try:
+        with open(os.path.join(cachedir, 'meta.json'), 'r') as f :
+            meta = json.load(f)
+        wave = np.load(os.path.join(cachedir, 'wave.npy'), mmap_mode='r')
+        flux = np.load(os.path.join(cachedir, 'flux.npy'), mmap_mode='r')
+    except (OSError, IOError, ValueError) :
+        return None
+    return RRTemplate(meta['template_type'], meta['sub_type'], wave, flux, filename=filename)
+
+
+def _write_disk_cache(cachedir, tx) :
+    '''
+    Writes template to cachedir. A temporary directory is renamed at the end,
+    so that concurrent processes never read an incomplete cache entry.
+    '''
+    log = get_logger()
+    tmpdir = cachedir+'.tmp'+str(os.getpid())
+    try:
+        os.makedirs(tmpdir)
+        np.save(os.path.join(tmpdir, 'wave.npy'), np.asarray(tx.wave))
+        np.save(os.path.join(tmpdir, 'flux.npy'), np.asarray(tx.flux))
+        meta = dict(template_type=tx.template_type, sub_type=tx.sub_type,
+                    filename=os.path.abspath(tx.filename))
+        with open(os.path.join(tmpdir, 'meta.json'), 'w') as f :
+            json.dump(meta, f)
+        os.rename(tmpdir, cachedir)
+    except OSError as err :
+        #- Another process may have written the same entry meanwhile, or the cache is not writable
+        if not os.path.isdir(cachedir) :
+            log.warning("Could not cache template "+tx.filename+" : "+str(err))
+    finally:
+        if os.path.isdir(tmpdir) : shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def get_template(filename, cache_dir=None, use_disk_cache=True) :
+    '''
+    Returns RRTemplate for a given template file, reading it
+      from the process-wide registry if already loaded,
+      else from the on-disk cache if available,
+      else from the FITS file (and then filling the caches).
+    '''
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key in _template_registry :
+        return _template_registry[key]
+
+    tx = None
+    if use_disk_cache :
+        if cache_dir is None : cache_dir = template_cache_dir()
+        cachedir = os.path.join(cache_dir, _cache_key(filename))
+        tx = _read_disk_cache(cachedir, filename)
+    if tx is None :
+        tx = _parse_template(filename)
+        if use_disk_cache : _write_disk_cache(cachedir, tx)
+
+    _template_registry[key] = tx
+    return tx
+
+
+def load_templates(filenames=None, cache_dir=None, use_disk_cache=True) :
+    '''
+    Returns dict { (SPECTYPE, SUBTYPE) : RRTemplate } of redrock templates
+
+    filenames : list of template files; default is redrock.templates.find_templates()
+    cache_dir : base directory of the on-disk cache; default is template_cache_dir()
+    use_disk_cache : if False, only the process-wide registry is used
+    '''
+    if filenames is None :
+        import redrock.templates
+        filenames = redrock.templates.find_templates()
+
+    templates = dict()
+    for filename in filenames :
+        tx = get_template(filename, cache_dir=cache_dir, use_disk_cache=use_disk_cache)
+        templates[(tx.template_type, tx.sub_type)] = tx
+
+    return templates
+
+
+def templates_hash(filenames=None) :
+    '''
+    Returns a hash identifying a set of template files (paths and mtimes)
+    filenames : list of template files; default is redrock.templates.find_templates()
+    '''
+    if filenames is None :
+        import redrock.templates
+        filenames = redrock.templates.find_templates()
+    keys = sorted([ _cache_key(x) for x in filenames ])
+    return hashlib.sha1(''.join(keys).encode('utf-8')).hexdigest()
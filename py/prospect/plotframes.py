@@ -9,7 +9,7 @@ TODO
 * better smoothing kernel, e.g. gaussian
 """
 
-import os, sys
+import os
 import argparse
 
 import numpy as np
@@ -21,10 +21,12 @@ import astropy.io.fits
 import bokeh.plotting as bk
 from bokeh.models import ColumnDataSource, CDSView, IndexFilter
 from bokeh.models import CustomJS, LabelSet, Label, Span, Legend, Panel, Tabs
+from bokeh.models import CustomJSTransform
+from bokeh.transform import transform
 from bokeh.models.widgets import (
     Slider, Button, Div, CheckboxGroup, CheckboxButtonGroup, RadioButtonGroup, 
     TextInput, Select, DataTable, TableColumn)
-from bokeh.layouts import widgetbox, Spacer, gridplot
+from bokeh.layouts import widgetbox, Spacer
 import bokeh.events
 # from bokeh.layouts import row, column
 
@@ -38,52 +40,21 @@ import desispec.frame
 #from . import utils_specviewer
 from prospect import utils_specviewer
 from prospect import mycoaddcam
+from prospect import mytemplates
+from prospect import mymodels
 from astropy.table import Table
 
-def create_model(spectra, zbest):
+def _as_str(column) :
+    """ Returns numpy array of str from a (possibly bytes) table column """
+    column = np.asarray(column)
+    if column.dtype.kind == 'S' : column = np.char.decode(column, 'ascii')
+    return column.astype(str)
+
+def _model_wave_grid(spectra):
     '''
-    Returns model_wave[nwave], model_flux[nspec, nwave], row matched to zbest,
-    which can be in a different order than spectra.
-    NB currently, zbest must have the same size as spectra.
+    Returns model_wave, keep : single wavelength grid across all cameras used for
+    model spectra, and dict of masks selecting the part of each camera grid kept
     '''
-    import redrock.templates
-    from desispec.interpolation import resample_flux
-
-    nspec = spectra.num_spectra()
-    assert len(zbest) == nspec
-
-    #- Load redrock templates; redirect stdout because redrock is chatty
-    saved_stdout = sys.stdout
-    sys.stdout = open('/dev/null', 'w')
-    try:
-        templates = dict()
-        for filename in redrock.templates.find_templates():
-            tx = redrock.templates.Template(filename)
-            templates[(tx.template_type, tx.sub_type)] = tx
-    except Exception as err:
-        sys.stdout = saved_stdout
-        raise(err)
-
-    sys.stdout = saved_stdout
-
-    #- Empty model flux arrays per band to fill
-    model_flux = dict()
-    for band in spectra.bands:
-        model_flux[band] = np.zeros(spectra.flux[band].shape)
-
-    targetids = spectra.target_ids()
-    for i in range(len(zbest)):
-        zb = zbest[i]
-        j = np.where(targetids == zb['TARGETID'])[0][0]
-
-        tx = templates[(zb['SPECTYPE'], zb['SUBTYPE'])]
-        coeff = zb['COEFF'][0:tx.nbasis]
-        model = tx.flux.T.dot(coeff).T
-        for band in spectra.bands:
-            mx = resample_flux(spectra.wave[band], tx.wave*(1+zb['Z']), model)
-            model_flux[band][i] = spectra.R[band][j].dot(mx)
-
-    #- Now combine to a single wavelength grid across all cameras
     #- TODO: assumes b,r,z all exist
     assert np.all([ band in spectra.wave.keys() for band in ['b','r','z'] ])
     br_split = 0.5*(spectra.wave['b'][-1] + spectra.wave['r'][0])
@@ -97,7 +68,54 @@ def create_model(spectra, zbest):
         spectra.wave['r'][keep['r']],
         spectra.wave['z'][keep['z']],
     ] )
+    return model_wave, keep
+
+def create_model(spectra, zbest, batch_size=500):
+    '''
+    Returns model_wave[nwave], model_flux[nspec, nwave], row matched to zbest,
+    which can be in a different order than spectra.
+    NB currently, zbest must have the same size as spectra.
+    Models are computed by blocks of targets sharing the same (SPECTYPE, SUBTYPE),
+    with at most batch_size targets per block, from log-lambda gridded templates.
+    '''
+    nspec = spectra.num_spectra()
+    assert len(zbest) == nspec
+
+    #- Redrock templates are read only once per process (and cached on disk)
+    templates = mytemplates.load_templates()
+
+    #- Empty model flux arrays per band to fill
+    model_flux = dict()
+    for band in spectra.bands:
+        model_flux[band] = np.zeros(spectra.flux[band].shape)
 
+    #- Index of (first) spectrum matching each zbest entry
+    targetids, first_index = np.unique(spectra.fibermap['TARGETID'], return_index=True)
+    k = np.clip(np.searchsorted(targetids, zbest['TARGETID']), 0, len(targetids)-1)
+    if np.any(targetids[k] != zbest['TARGETID']) : raise RuntimeError("zbest table cannot match spectra.")
+    ispec = first_index[k]
+
+    #- Group zbest entries by template
+    spectype = _as_str(zbest['SPECTYPE'])
+    subtype = _as_str(zbest['SUBTYPE'])
+    tx_keys, tx_index = np.unique(np.char.add(np.char.add(spectype, '|'), subtype), return_inverse=True)
+    zb_coeff = np.asarray(zbest['COEFF'])
+    zb_z = np.asarray(zbest['Z'])
+
+    for igroup in range(len(tx_keys)):
+        rows = np.flatnonzero(tx_index == igroup)
+        tx = templates[(spectype[rows[0]], subtype[rows[0]])]
+        #- Redshifting a log-lambda gridded basis is an index shift
+        txbasis = tx.loglam_basis()
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start+batch_size]
+            for band in spectra.bands:
+                mx = txbasis.models(spectra.wave[band], zb_coeff[batch, 0:tx.nbasis], zb_z[batch])
+                rdata = spectra.resolution_data[band][ispec[batch]]
+                model_flux[band][batch] = mymodels.apply_resolution(rdata, mx)
+
+    #- Now combine to a single wavelength grid across all cameras
+    model_wave, keep = _model_wave_grid(spectra)
     mflux = np.concatenate( [
         model_flux['b'][:, keep['b']],
         model_flux['r'][:, keep['r']],
@@ -125,57 +143,103 @@ def _viewer_urls(spectra, zoom=13, layer='dr8'):
             for i in range(len(ra))]
 
 
-def make_cds_spectra(spectra, with_noise) :
-    """ Creates column data source for b,r,z observed spectra """
+def wave_transform(waveshift_cds, key) :
+    """ CustomJSTransform used to display wavelengths : origwave * waveshift_cds.data[key][0]
+        The displayed wavelengths of all CDS sharing this transform are changed by updating
+        the scale factor in waveshift_cds, then emitting a change of the CDS (no array is stored).
+    """
+    return CustomJSTransform(args=dict(waveshift_cds=waveshift_cds, key=key), v_func="""
+        var waveshift = waveshift_cds.data[key][0]
+        var plotwave = new Float64Array(xs.length)
+        for (var j=0; j<xs.length; j++) plotwave[j] = xs[j] * waveshift
+        return plotwave
+    """)
 
+def _cds_array(array, compact) :
+    """ Array to be stored in a CDS : converted to float32 if compact is True
+        (bokeh serializes float32/float64 numpy arrays in binary form)
+    """
+    if compact : return np.asarray(array, dtype=np.float32)
+    return array
+
+def make_cds_spectra(spectra, with_noise, context=None, compact_cds=False) :
+    """ Creates column data source for b,r,z observed spectra
+        context : utils_specviewer.ViewerContext for spectra
+        compact_cds : if True, arrays are stored as float32
+    """
+
+    if context is None : context = utils_specviewer.ViewerContext(spectra)
     cds_spectra = list()
     for band in spectra.bands:
         cdsdata=dict(
-            origwave=spectra.wave[band].copy(),
-            plotwave=spectra.wave[band].copy(),
+            origwave=_cds_array(spectra.wave[band], compact_cds).copy(),
             )
+        #- Conversion is done once for the whole (nspec, nwave) block
+        flux = _cds_array(spectra.flux[band], compact_cds)
+        if with_noise : noise = _cds_array(context.noise(band), compact_cds)
         for i in range(spectra.num_spectra()):
             key = 'origflux'+str(i)
-            cdsdata[key] = spectra.flux[band][i]
+            cdsdata[key] = flux[i]
             if with_noise :
                 key = 'orignoise'+str(i)
-                noise = np.zeros(len(spectra.ivar[band][i]))
-                w, = np.where( (spectra.ivar[band][i] > 0))
-                noise[w] = 1/np.sqrt(spectra.ivar[band][i][w])
-                cdsdata[key] = noise
+                cdsdata[key] = noise[i]
         cdsdata['plotflux'] = cdsdata['origflux0']
         if with_noise : cdsdata['plotnoise'] = cdsdata['orignoise0'] 
         cds_spectra.append( bk.ColumnDataSource(cdsdata, name=band) )
     
     return cds_spectra
 
-def make_cds_coaddcam_spec(spectra, with_noise) :
+def make_cds_coaddcam_spec(spectra, with_noise, context=None, compact_cds=False) :
     """ Creates column data source for camera-coadded observed spectra 
         Do NOT store all coadded spectra in CDS obj, to reduce size of html files
         Except for the first spectrum, coaddition is done later in javascript
+        context : utils_specviewer.ViewerContext for spectra
+        compact_cds : if True, arrays are stored as float32
     """
 
-    coadd_wave, coadd_flux, coadd_ivar = mycoaddcam.mycoaddcam(spectra)
+    if context is None : context = utils_specviewer.ViewerContext(spectra)
+    coadd_wave, coadd_flux, coadd_ivar = context.coaddcam()
     cds_coaddcam_data = dict(
-        origwave = coadd_wave.copy(),
-        plotwave = coadd_wave.copy(),
-        plotflux = coadd_flux[0,:].copy(),
-        plotnoise = np.ones(len(coadd_wave))
+        origwave = _cds_array(coadd_wave, compact_cds).copy(),
+        plotflux = _cds_array(coadd_flux[0,:], compact_cds).copy(),
+        plotnoise = _cds_array(np.ones(len(coadd_wave)), compact_cds)
     )
     if with_noise :
-        w, = np.where( (coadd_ivar[0,:] > 0) )
-        cds_coaddcam_data['plotnoise'][w] = 1/np.sqrt(coadd_ivar[0,:][w])
+        cds_coaddcam_data['plotnoise'] = _cds_array(context.coaddcam_noise()[0,:], compact_cds).copy()
     cds_coaddcam_spec = bk.ColumnDataSource(cds_coaddcam_data)
     
     return cds_coaddcam_spec
 
-def make_cds_model(model) :
-    """ Creates column data source for model spectrum """
+def make_coaddcam_maps(spectra) :
+    """ Maps (indices and interpolation weights) from which camera-coadded spectra are computed
+        in javascript, on the same wavelength grid as make_cds_coaddcam_spec.
+        See mycoaddcam.CoaddCamOperator.linear_maps; cameras are given as indices in spectra.bands
+        (ie. in the list of CDS returned by make_cds_spectra)
+    """
+
+    operator = mycoaddcam.get_coaddcam_operator(spectra.wave, spectra.bands)
+    maps = operator.linear_maps()
+    coaddcam_maps = dict(
+        nwave = int(operator.wave.size),
+        copy = [ [spectra.bands.index(x[0])]+list(x[1:]) for x in maps['copy'] ],
+        over_out = maps['over_out'].tolist()
+    )
+    for k in ['1', '2'] :
+        coaddcam_maps['over_band'+k] = [ spectra.bands.index(band) for band in maps['over_band'+k] ]
+        coaddcam_maps['over_index'+k] = maps['over_index'+k].tolist()
+        coaddcam_maps['over_frac'+k] = maps['over_frac'+k].tolist()
+
+    return coaddcam_maps
+
+def make_cds_model(model, compact_cds=False) :
+    """ Creates column data source for model spectrum
+        compact_cds : if True, arrays are stored as float32
+    """
     
     mwave, mflux = model
+    mflux = _cds_array(mflux, compact_cds)
     cds_model_data = dict(
-        origwave = mwave.copy(),
-        plotwave = mwave.copy(),
+        origwave = _cds_array(mwave, compact_cds).copy(),
         plotflux = np.zeros(len(mwave)),
     )
     for i in range(len(mflux)):
@@ -187,8 +251,155 @@ def make_cds_model(model) :
 
     return cds_model
 
-def make_cds_targetinfo(spectra, zcatalog, is_coadded, mask_type, username=" ") :
-    """ Creates column data source for target-related metadata, from zcatalog, fibermap and VI files """
+def _template_model(model_wave, restwave, basis, coeff, z) :
+    """ Model from template basis, linearly interpolated in log(wave) : same as template_model() in update_plot.js """
+    flux = np.dot(coeff, basis)
+    return np.interp(np.log(model_wave/(1+z)), np.log(restwave), flux, left=0, right=0)
+
+def make_cds_model_templates(spectra, zcatalog, compact_cds=False) :
+    """ Creates column data sources for a compact model : template basis vectors are stored
+        once per (SPECTYPE, SUBTYPE) used in zcatalog, and models are rebuilt in javascript
+        from per-target (z, coeff, spectype). Models are not convolved by the resolution matrix.
+        zcatalog must be row-matched to spectra.
+        Returns cds_model, dict of template CDS, list of template keys, list of coefficients
+        compact_cds : if True, the model arrays are stored as float32 (template arrays always are)
+    """
+    templates = mytemplates.load_templates()
+    model_wave, dummy = _model_wave_grid(spectra)
+    spectype = _as_str(zcatalog['SPECTYPE'])
+    subtype = _as_str(zcatalog['SUBTYPE'])
+    model_keys = [ x+'|'+y for x, y in zip(spectype, subtype) ]
+    zcat_z = np.asarray(zcatalog['Z'])
+
+    #- Templates are resampled on a log(wave) grid matching the pixel size of cameras,
+    #- restricted to the rest-frame range seen by the targets in zcatalog
+    dloglam = np.median(np.diff(np.log(model_wave)))
+    cds_templates = dict()
+    basis = dict()
+    for key in np.unique(model_keys) :
+        tx = templates[tuple(key.split('|'))]
+        zz = zcat_z[np.array(model_keys) == key]
+        logmin = np.log(model_wave[0]/(1+np.max(zz))) - dloglam
+        logmax = np.log(model_wave[-1]/(1+np.min(zz))) + dloglam
+        restwave = np.exp(np.arange(logmin, logmax+dloglam, dloglam))
+        basis[key] = (restwave, mymodels.resample_redshifted(restwave, tx.wave, tx.flux, np.zeros(tx.nbasis)))
+        cdsdata = dict(restwave=restwave.astype(np.float32))
+        for i in range(tx.nbasis) :
+            cdsdata['basis'+str(i)] = basis[key][1][i].astype(np.float32)
+        cds_templates[key] = bk.ColumnDataSource(cdsdata, name=key)
+
+    model_coeffs = list()
+    for i, key in enumerate(model_keys) :
+        nbasis = len(basis[key][1])
+        model_coeffs.append( [ float(x) for x in zcatalog['COEFF'][i][0:nbasis] ] )
+
+    #- Only the first model is computed here
+    restwave, tx_basis = basis[model_keys[0]]
+    mflux0 = _template_model(model_wave, restwave, tx_basis, model_coeffs[0], zcat_z[0])
+    cds_model = bk.ColumnDataSource(dict(
+        origwave = _cds_array(model_wave, compact_cds).copy(),
+        plotflux = _cds_array(mflux0, compact_cds),
+        origflux0 = _cds_array(mflux0, compact_cds).copy()
+    ))
+
+    return cds_model, cds_templates, model_keys, model_coeffs
+
+def write_sidecar(sources, nspec, filename, nspec_per_file=None, nprefetch=4) :
+    """ Moves per-spectrum arrays (origflux<i>, orignoise<i>) out of CDS objects, into binary
+        "sidecar" file(s) from which they are fetched when needed by update_plot.js (see load_sidecar.js).
+        Arrays of spectrum 0 are kept in the CDS, so that the first spectrum is displayed right away.
+        sources : list of CDS; columns are moved only if present for all nspec spectra
+        filename : name of the sidecar file (.bin). If nspec_per_file < nspec, spectra are
+            split into several files filename_<k>.bin, each with nspec_per_file spectra.
+        nprefetch : number of neighbouring spectra fetched together with the requested one
+        Each file is a contiguous blob of little-endian float32, made of fixed-size records (one per spectrum).
+        Returns the layout (dict) to be passed to javascript :
+            files : file basenames (relative to the html page), nspec, nspec_per_file, nprefetch,
+            record_size : number of floats per record,
+            fields : list of { source : index in sources, column : column prefix, offset, length },
+                offset and length (in floats) giving the position of the array in each record.
+    """
+    if nspec_per_file is None or nspec_per_file > nspec : nspec_per_file = nspec
+    fields = list()
+    record_size = 0
+    for i_source, source in enumerate(sources) :
+        for column in ['origflux', 'orignoise'] :
+            if all([ (column+str(i)) in source.data for i in range(nspec) ]) :
+                length = len(source.data[column+'0'])
+                fields.append( dict(source=i_source, column=column, offset=record_size, length=length) )
+                record_size += length
+    if len(fields) == 0 : raise RuntimeError("No per-spectrum arrays to be stored in sidecar file")
+
+    nfiles = (nspec+nspec_per_file-1) // nspec_per_file
+    if nfiles == 1 :
+        files = [ filename ]
+    else :
+        files = [ filename.replace('.bin', '_'+str(k)+'.bin') for k in range(nfiles) ]
+    for k, thefile in enumerate(files) :
+        i_specs = range(k*nspec_per_file, min((k+1)*nspec_per_file, nspec))
+        records = np.zeros((len(i_specs), record_size), dtype='<f4')
+        for field in fields :
+            data = sources[field['source']].data
+            records[:, field['offset']:field['offset']+field['length']] = [ data[field['column']+str(i)] for i in i_specs ]
+        records.tofile(thefile)
+
+    for i_source in np.unique([ field['source'] for field in fields ]) :
+        source = sources[i_source]
+        moved = [ field['column']+str(i) for field in fields if field['source'] == i_source for i in range(1, nspec) ]
+        source.data = { key:val for key, val in source.data.items() if key not in moved }
+
+    return dict(files=[ os.path.basename(x) for x in files ], nspec=nspec, nspec_per_file=nspec_per_file,
+                nprefetch=nprefetch, record_size=record_size, fields=fields)
+
+#- Decimation factors of spectra displayed in the main figure, see make_cds_lod()
+_lod_factors = [1, 4, 16]
+
+def decimate_minmax(wave, values, factor) :
+    """ Min/max decimation of values[nwave] : each bucket of factor points is replaced by 2 points,
+        at the first and last wavelengths of the bucket, with the min and max values
+        of the bucket (in order of occurrence). NaN values are ignored.
+        Same as decimate_minmax() in update_lod.js
+        Returns (wave_out, values_out), each with 2*ceil(nwave/factor) elements
+    """
+    nwave = len(wave)
+    nbuckets = (nwave+factor-1) // factor
+    start = np.arange(nbuckets)*factor
+    end = np.minimum(start+factor, nwave)
+    wave_out = np.stack([wave[start], wave[end-1]], axis=1).ravel()
+    padded = np.full(nbuckets*factor, np.nan)
+    padded[:nwave] = values
+    padded = padded.reshape(nbuckets, factor)
+    valid = ~np.isnan(padded)
+    imin = np.argmin(np.where(valid, padded, np.inf), axis=1)
+    imax = np.argmax(np.where(valid, padded, -np.inf), axis=1)
+    rows = np.arange(nbuckets)
+    values_out = np.stack([ padded[rows, np.minimum(imin, imax)], padded[rows, np.maximum(imin, imax)] ], axis=1)
+    values_out[~np.any(valid, axis=1)] = np.nan
+    return wave_out, values_out.ravel()
+
+def make_cds_lod(source, npix, lod_factors=_lod_factors) :
+    """ Creates column data source displaying source (origwave, plotflux, optional plotnoise)
+        in the main figure, decimated according to the number of screen pixels npix, for the
+        full wavelength range. It is then updated in javascript, see update_lod.js
+    """
+    wave = np.asarray(source.data['origwave'])
+    level = lod_factors[0]
+    for factor in lod_factors[1:] :
+        if 2*len(wave)/factor >= npix : level = factor
+    cdsdata = dict()
+    for column in ['plotflux', 'plotnoise'] :
+        if column not in source.data : continue
+        if level == 1 :
+            cdsdata['origwave'], cdsdata[column] = wave, np.asarray(source.data[column])
+        else :
+            cdsdata['origwave'], cdsdata[column] = decimate_minmax(wave, np.asarray(source.data[column]), level)
+    return ColumnDataSource(cdsdata, name=source.name)
+
+def make_cds_targetinfo(spectra, zcatalog, is_coadded, mask_type, username=" ", context=None) :
+    """ Creates column data source for target-related metadata, from zcatalog, fibermap and VI files
+        Also includes per-spectrum statistics (y-range, median S/N per band, masked fraction),
+        see utils_specviewer.ViewerContext.stats
+    """
 
     assert mask_type in ['SV1_DESI_TARGET', 'DESI_TARGET', 'CMX_TARGET']
     target_info = list()
@@ -256,6 +467,10 @@ def make_cds_targetinfo(spectra, zcatalog, is_coadded, mask_type, username=" ")
         cds_targetinfo.add(zcatalog['ZWARN'], name='zwarn')
         cds_targetinfo.add(zcatalog['DELTACHI2'], name='deltachi2')
 
+    if context is None : context = utils_specviewer.ViewerContext(spectra)
+    for key, values in context.stats().items() :
+        cds_targetinfo.add(values, name=key)
+
     nspec = spectra.num_spectra()
     if not is_coadded and 'EXPID' in spectra.fibermap.keys() :
         cds_targetinfo.add(spectra.fibermap['EXPID'], name='expid')
@@ -280,46 +495,75 @@ def make_cds_targetinfo(spectra, zcatalog, is_coadded, mask_type, username=" ")
     return cds_targetinfo
 
 
-def grid_thumbs(spectra, thumb_width, x_range=(3400,10000), thumb_height=None, resamp_factor=15, ncols_grid=5, titles=None) :
+def grid_thumbs(spectra, thumb_width, x_range=(3400,10000), thumb_height=None, resamp_factor=15, ncols_grid=5, titles=None, context=None) :
     '''
-    Create a bokeh gridplot of thumbnail pictures from spectra
+    Create a bokeh gallery of thumbnail pictures from spectra
     - coadd arms
     - smooth+resample to reduce size of embedded CDS, according to resamp_factor
     - titles : optional list of titles for each thumb
+    - context : utils_specviewer.ViewerContext for spectra
+    All thumbs are drawn in a single figure, with one multi_line glyph : thumb i_spec
+    is placed in the unit cell [col, col+1] x [-row-1, -row] of the figure, with
+    (row, col) = divmod(i_spec, ncols_grid).
+    Returns (figure, cells_cds) : cells_cds has one row per thumb (i_spec, cell limits),
+    so that a tap at (x,y) in the figure can be mapped back to i_spec.
     '''
 
     if thumb_height is None : thumb_height = thumb_width//2
-    if titles is not None : assert len(titles) == spectra.num_spectra()
-    thumb_wave, thumb_flux, dummy = mycoaddcam.mycoaddcam(spectra)
-    
-    thumb_plots = []
-    for i_spec in range(spectra.num_spectra()) :
-        # other option use CustomJSTransform ?
-        # (https://docs.bokeh.org/en/1.1.0/docs/user_guide/data.html)
-        x_vals = (thumb_wave[::resamp_factor])[resamp_factor:-resamp_factor]
-        y_vals = scipy.ndimage.filters.gaussian_filter1d(thumb_flux[i_spec,:], sigma=resamp_factor, mode='nearest') 
-        y_vals = (y_vals[::resamp_factor])[resamp_factor:-resamp_factor]
-        x_vals = x_vals[~np.isnan(y_vals)] # TODO - should we keep that in the end ?
-        y_vals = y_vals[~np.isnan(y_vals)]            
-        yampl = np.max(y_vals) - np.min(y_vals)
-        ymin = np.min(y_vals) - 0.1*yampl
-        ymax = np.max(y_vals) + 0.1*yampl
-        plot_title = None
-        if titles is not None : plot_title = titles[i_spec]
-        mini_plot = bk.figure(plot_width=thumb_width, plot_height=thumb_height, x_range=x_range, y_range=(ymin,ymax), title=plot_title)
-        mini_plot.line(x_vals, y_vals, line_color='red')
-        mini_plot.xaxis.visible = False
-        mini_plot.yaxis.visible = False
-        mini_plot.min_border_left = 0
-        mini_plot.min_border_right = 0
-        mini_plot.min_border_top = 0
-        mini_plot.min_border_bottom = 0
-        thumb_plots.append(mini_plot)
-
-    return gridplot(thumb_plots, ncols=ncols_grid, toolbar_location=None, sizing_mode='scale_width')
-
-
-def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_zcat=True, model=None, notebook=False, vidata=None, is_coadded=True, title=None, html_dir=None, with_imaging=True, with_noise=True, with_coaddcam=True, mask_type='DESI_TARGET', with_thumb_tab=True, with_vi_widgets=True, with_thumb_only_page=False):
+    nspec = spectra.num_spectra()
+    if titles is not None : assert len(titles) == nspec
+    if context is None : context = utils_specviewer.ViewerContext(spectra)
+    thumb_wave, thumb_flux, dummy = context.coaddcam()
+    nrows_grid = (nspec+ncols_grid-1) // ncols_grid
+
+    x_vals = (thumb_wave[::resamp_factor])[resamp_factor:-resamp_factor]
+    y_all = scipy.ndimage.filters.gaussian_filter1d(thumb_flux, sigma=resamp_factor, axis=1, mode='nearest')
+    y_all = (y_all[:, ::resamp_factor])[:, resamp_factor:-resamp_factor]
+    #- Each thumb is rescaled into its cell, with small margins
+    x_cell = 0.02 + 0.96*(x_vals-x_range[0])/(x_range[1]-x_range[0])
+    i_row, i_col = np.divmod(np.arange(nspec), ncols_grid)
+    xs, ys = [], []
+    for i_spec in range(nspec) :
+        y_vals = y_all[i_spec]
+        w, = np.where(~np.isnan(y_vals))
+        if w.size > 0 :
+            ymin, ymax = np.min(y_vals[w]), np.max(y_vals[w])
+        else :
+            ymin, ymax = 0, 1
+        yampl = ymax - ymin
+        if yampl == 0 : yampl = 1
+        #- Same y range as before : [ymin-0.1*yampl, ymax+0.1*yampl]
+        y_cell = (y_vals[w]-ymin+0.1*yampl)/(1.2*yampl)
+        xs.append(i_col[i_spec] + x_cell[w])
+        ys.append(y_cell - i_row[i_spec] - 1)
+
+    gallery = bk.figure(plot_width=thumb_width*ncols_grid, plot_height=thumb_height*nrows_grid,
+                        x_range=(0,ncols_grid), y_range=(-nrows_grid,0), tools="", toolbar_location=None,
+                        sizing_mode='scale_width')
+    gallery.multi_line(xs=xs, ys=ys, line_color='red')
+    cells_cds = ColumnDataSource(data=dict(
+        i_spec = np.arange(nspec),
+        left = i_col.astype(float), right = i_col+1.,
+        bottom = -i_row-1., top = -i_row.astype(float) ))
+    gallery.quad(left='left', right='right', bottom='bottom', top='top', source=cells_cds,
+                 fill_alpha=0, line_color='lightgrey')
+    if titles is not None :
+        cells_cds.data['title'] = list(titles)
+        gallery.text(x='left', y='top', text='title', source=cells_cds, x_offset=2, y_offset=2,
+                     text_baseline='top', text_font_size='8pt')
+    gallery.xaxis.visible = False
+    gallery.yaxis.visible = False
+    gallery.xgrid.visible = False
+    gallery.ygrid.visible = False
+    gallery.min_border_left = 0
+    gallery.min_border_right = 0
+    gallery.min_border_top = 0
+    gallery.min_border_bottom = 0
+
+    return (gallery, cells_cds)
+
+
+def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_zcat=True, model=None, model_store=None, notebook=False, vidata=None, is_coadded=True, title=None, html_dir=None, with_imaging=True, with_noise=True, with_coaddcam=True, mask_type='DESI_TARGET', with_thumb_tab=True, with_vi_widgets=True, with_thumb_only_page=False, compact_model=False, context=None, compact_cds=False, sidecar=False, sidecar_chunk=None, with_lod=True, with_smoothing_worker=True, render_cache_size=32):
     '''
     Main prospect routine, creates a bokeh document from a set of spectra and fits
 
@@ -332,6 +576,8 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
     model_from_zcat : if True, model spectra will be computed from the input zcatalog
     model : if set, use this input set of model spectra (instead of computing it from zcat)
         model format (mwave, mflux); model must be entry-matched to zcatalog.
+    model_store : mymodels.ModelStore; if set and model_from_zcat is True, models are taken
+        from this store (and computed only if missing)
     notebook : if True, bokeh outputs the viewer to notebook, else to a (static) html page
     vidata : VI information to be preloaded and displayed. Currently disabled.
     is_coadded : set to True if spectra are coadds
@@ -345,8 +591,31 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
     with_thumb_only_page (requires notebook==False) : also create a light html page including only the thumb gallery
     mask_type : mask type to identify target categories from the fibermap. Available : DESI_TARGET,
         SV1_DESI_TARGET, CMX_TARGET. Default : DESI_TARGET.
+    compact_model : (requires zcatalog and model_from_zcat) instead of storing one model spectrum
+        per target, store the redrock template basis vectors and rebuild models in javascript
+    context : utils_specviewer.ViewerContext for spectra, to share computations (camera coadd,
+        models...) with other consumers, eg. utils_specviewer.miniplot_spectrum
+    compact_cds : if True, spectra, noise and models are stored in the html page as float32 arrays
+        instead of float64, which divides the page size by ~2
+    sidecar : (requires notebook==False) if True, arrays of spectra/noise/models are not embedded
+        in the html page, but written to a binary file (specviewer_<title>.bin) next to it.
+        They are fetched by the browser when needed (html_dir must be served over http(s)).
+    sidecar_chunk : if set, sidecar data is split into files of sidecar_chunk spectra
+        (specviewer_<title>_<k>.bin), each fetched only when one of its spectra is displayed.
+        This allows a single html page for a large number of spectra.
+    with_lod : if True, the main figure displays min/max-decimated spectra (by factors 4 or 16)
+        when zoomed out, and full-resolution spectra once zoomed in. The zoom figure always
+        displays full-resolution spectra.
+    with_smoothing_worker : if True, spectra are smoothed in a Web Worker (if the browser
+        allows it), so that the page stays responsive while smoothing.
+    render_cache_size : number of rendered spectra (smoothed arrays, camera coadd, y-range) kept
+        in memory by the browser, so that going back to a recently displayed spectrum is instant.
+        The next spectrum is also rendered in advance when the browser is idle. 0 : no cache.
     '''
 
+    if compact_model and (zcatalog is None or not model_from_zcat) :
+        raise ValueError("compact_model requires a zcatalog, with model_from_zcat=True")
+
     #- If inputs are frames, convert to a spectra object
     if isinstance(spectra, list) and isinstance(spectra[0], desispec.frame.Frame):
         spectra = utils_specviewer.frames2spectra(spectra, nspec=nspec, startspec=startspec)
@@ -355,10 +624,12 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
         frame_input = False
         assert nspec is None
     nspec = spectra.num_spectra() # NB can be less than input "nspec"
+    if context is None :
+        context = utils_specviewer.ViewerContext(spectra)
+    else :
+        assert context.spectra is spectra
     #- Set masked bins to NaN so that Bokeh won't plot them
-    for band in spectra.bands:
-        bad = (spectra.ivar[band] == 0.0) | (spectra.mask[band] != 0)
-        spectra.flux[band][bad] = np.nan
+    context.mask_bad_pixels()
 
     if frame_input and title is None:
         meta = spectra.meta
@@ -370,16 +641,17 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
     #- Reorder zcatalog to match input targets
     #- TODO: allow more than one zcatalog entry with different ZNUM per targetid
     if zcatalog is not None:
-        zcatalog, kk = utils_specviewer.match_zcat_to_spectra(zcatalog, spectra)
+        zcatalog, kk = context.match_zcat(zcatalog)
         
         #- Also need to re-order input model fluxes
         if model is not None :
             assert model_from_zcat == False
             mwave, mflux = model
             model = mwave, mflux[kk]
+            context.set_model(model)
 
-        if model_from_zcat == True :
-            model = create_model(spectra, zcatalog)
+        if model_from_zcat == True and not compact_model :
+            model = context.get_model(zcatalog=zcatalog, model_store=model_store)
 
     #-----
     #- Initialize Bokeh output
@@ -393,26 +665,42 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
 
     #-----
     #- Gather information into ColumnDataSource objects for Bokeh
-    cds_spectra = make_cds_spectra(spectra, with_noise)
+    cds_spectra = make_cds_spectra(spectra, with_noise, context=context, compact_cds=compact_cds)
     if with_coaddcam :
-        cds_coaddcam_spec = make_cds_coaddcam_spec(spectra, with_noise)
+        cds_coaddcam_spec = make_cds_coaddcam_spec(spectra, with_noise, context=context, compact_cds=compact_cds)
+        coaddcam_maps = make_coaddcam_maps(spectra)
     else :
-        cds_coaddcam_spec = None
-    if model is not None:
-        cds_model = make_cds_model(model)
+        cds_coaddcam_spec = coaddcam_maps = None
+    cds_model_templates = None
+    if compact_model :
+        cds_model, cds_model_templates, model_keys, model_coeffs = make_cds_model_templates(spectra, zcatalog, compact_cds=compact_cds)
+    elif model is not None:
+        cds_model = make_cds_model(model, compact_cds=compact_cds)
     else:
         cds_model = None
     if notebook and ("USER" in os.environ) : 
         username = os.environ['USER']
     else :
         username = " "
-    cds_targetinfo = make_cds_targetinfo(spectra, zcatalog, is_coadded, mask_type, username=username)
+    cds_targetinfo = make_cds_targetinfo(spectra, zcatalog, is_coadded, mask_type, username=username, context=context)
+    if compact_model :
+        cds_targetinfo.add(model_keys, name='model_key')
+        cds_targetinfo.add(model_coeffs, name='model_coeff')
+    sidecar_layout = sidecar_sources = sidecar_status = None
+    if sidecar :
+        assert notebook == False
+        sidecar_sources = [ x for x in cds_spectra+[cds_model] if x is not None ]
+        sidecar_file = os.path.join(html_dir, "specviewer_"+title+".bin")
+        sidecar_layout = write_sidecar(sidecar_sources, nspec, sidecar_file, nspec_per_file=sidecar_chunk)
+        sidecar_status = ColumnDataSource(dict(loaded=[0]))
 
 
     #-------------------------
     #-- Graphical objects --
     #-------------------------
 
+    js_dir = os.path.join(os.path.dirname(__file__),os.pardir,os.pardir,"js")
+
 
     #-----
     #- Main figure
@@ -446,28 +734,55 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
     alpha_discrete = 0.2 # alpha for "almost-hidden" curves (single-arm spectra and noise by default)
     if not with_coaddcam : alpha_discrete = 1
     
+    #- Displayed wavelengths (observed or rest frame) : origwave times a scale factor, see zslider_callback
+    waveshift_cds = ColumnDataSource(dict(spec=[1.0], model=[1.0]))
+    spec_plotwave = transform('origwave', wave_transform(waveshift_cds, 'spec'))
+    model_plotwave = transform('origwave', wave_transform(waveshift_cds, 'model'))
+
+    #- Level of detail : the main figure displays decimated copies of spectra (lod_sources), see update_lod.js
+    lod_inputs = list(cds_spectra)
+    if with_coaddcam : lod_inputs.append(cds_coaddcam_spec)
+    if cds_model is not None : lod_inputs.append(cds_model)
+    lod_keys = [ 'model' if x is cds_model else 'spec' for x in lod_inputs ]
+    if with_lod :
+        lod_sources = [ make_cds_lod(x, plot_width) for x in lod_inputs ]
+    else :
+        lod_sources = None
+    main_sources = { x.id : (lod_sources[i] if with_lod else x) for i, x in enumerate(lod_inputs) }
+
     data_lines = list()
     for spec in cds_spectra:
-        lx = fig.line('plotwave', 'plotflux', source=spec, line_color=colors[spec.name], line_alpha=alpha_discrete)
+        lx = fig.line(spec_plotwave, 'plotflux', source=main_sources[spec.id], line_color=colors[spec.name], line_alpha=alpha_discrete)
         data_lines.append(lx)
     if with_coaddcam :
-        lx = fig.line('plotwave', 'plotflux', source=cds_coaddcam_spec, line_color=colors['coadd'], line_alpha=1)
+        lx = fig.line(spec_plotwave, 'plotflux', source=main_sources[cds_coaddcam_spec.id], line_color=colors['coadd'], line_alpha=1)
         data_lines.append(lx)
     
     noise_lines = list()
     if with_noise :
         for spec in cds_spectra :
-            lx = fig.line('plotwave', 'plotnoise', source=spec, line_color=noise_colors[spec.name], line_alpha=alpha_discrete)
+            lx = fig.line(spec_plotwave, 'plotnoise', source=main_sources[spec.id], line_color=noise_colors[spec.name], line_alpha=alpha_discrete)
             noise_lines.append(lx)
         if with_coaddcam :
-            lx = fig.line('plotwave', 'plotnoise', source=cds_coaddcam_spec, line_color=noise_colors['coadd'], line_alpha=1)
+            lx = fig.line(spec_plotwave, 'plotnoise', source=main_sources[cds_coaddcam_spec.id], line_color=noise_colors['coadd'], line_alpha=1)
             noise_lines.append(lx)
 
     model_lines = list()
     if cds_model is not None:
-        lx = fig.line('plotwave', 'plotflux', source=cds_model, line_color='black')
+        lx = fig.line(model_plotwave, 'plotflux', source=main_sources[cds_model.id], line_color='black')
         model_lines.append(lx)
 
+    with open(os.path.join(js_dir,"update_lod.js"), 'r') as f : update_lod_code = f.read()
+    if with_lod :
+        lod_callback = CustomJS(
+            args = dict(lod_inputs=lod_inputs, lod_sources=lod_sources, lod_keys=lod_keys,
+                        waveshift_cds=waveshift_cds, fig=fig, lod_factors=_lod_factors),
+            code = update_lod_code + """
+            update_lod(lod_inputs, lod_sources, lod_keys, waveshift_cds, fig, lod_factors, false)
+            """)
+        fig.x_range.js_on_change('start', lod_callback)
+        fig.x_range.js_on_change('end', lod_callback)
+
     legend_items = [("data",  data_lines[-1::-1])] #- reversed to get blue as lengend entry
     if cds_model is not None : 
         legend_items.append(("model", model_lines))
@@ -489,20 +804,20 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
     zoom_data_lines = list()
     zoom_noise_lines = list()
     for spec in cds_spectra:
-        zoom_data_lines.append(zoomfig.line('plotwave', 'plotflux', source=spec,
+        zoom_data_lines.append(zoomfig.line(spec_plotwave, 'plotflux', source=spec,
             line_color=colors[spec.name], line_width=1, line_alpha=alpha_discrete))
         if with_noise :
-            zoom_noise_lines.append(zoomfig.line('plotwave', 'plotnoise', source=spec,
+            zoom_noise_lines.append(zoomfig.line(spec_plotwave, 'plotnoise', source=spec,
                             line_color=noise_colors[spec.name], line_width=1, line_alpha=alpha_discrete))
     if with_coaddcam :
-        zoom_data_lines.append(zoomfig.line('plotwave', 'plotflux', source=cds_coaddcam_spec, line_color=colors['coadd'], line_alpha=1))
+        zoom_data_lines.append(zoomfig.line(spec_plotwave, 'plotflux', source=cds_coaddcam_spec, line_color=colors['coadd'], line_alpha=1))
         if with_noise :
-            lx = zoomfig.line('plotwave', 'plotnoise', source=cds_coaddcam_spec, line_color=noise_colors['coadd'], line_alpha=1)
+            lx = zoomfig.line(spec_plotwave, 'plotnoise', source=cds_coaddcam_spec, line_color=noise_colors['coadd'], line_alpha=1)
             zoom_noise_lines.append(lx)
             
     zoom_model_lines = list()
     if cds_model is not None:
-        zoom_model_lines.append(zoomfig.line('plotwave', 'plotflux', source=cds_model, line_color='black'))
+        zoom_model_lines.append(zoomfig.line(model_plotwave, 'plotflux', source=cds_model, line_color='black'))
 
     #- Callback to update zoom window x-range
     zoom_callback = CustomJS(
@@ -549,8 +864,6 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
     #-- Widgets and callbacks --
     #-------------------------
 
-    js_dir = os.path.join(os.path.dirname(__file__),os.pardir,os.pardir,"js")
-
     #-----
     #- Ifiberslider and smoothing widgets
     # Ifiberslider's value controls which spectrum is displayed
@@ -592,10 +905,11 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
         
         // y-range : same function as in update_plot()
         function get_y_minmax(pmin, pmax, data) {
-            var dx = data.slice().filter(Boolean)
-            dx.sort()
+            var dx = Float64Array.from(data).filter(function(x) { return isFinite(x) })
+            if (dx.length == 0) return [0, 0]
+            dx.sort() // numerical sort, as dx is a typed array
             var imin = Math.floor(pmin * dx.length)
-            var imax = Math.floor(pmax * dx.length)
+            var imax = Math.min(Math.floor(pmax * dx.length), dx.length-1)
             return [dx[imin], dx[imax]]
         }
         var ymin = 0.0
@@ -648,8 +962,10 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
             line_data=line_data, lines=lines, line_labels=line_labels,
             zlines=zoom_lines, zline_labels=zoom_line_labels,
             fig=fig,
+            waveshift_cds=waveshift_cds,
+            lod_inputs=lod_inputs, lod_sources=lod_sources, lod_keys=lod_keys, lod_factors=_lod_factors,
             ),
-        code="""
+        code=update_lod_code + """
         var z = zslider.value + dzslider.value
 //        z_display.text = "<b>z<sub>disp</sub> = " + z.toFixed(4) + "</b>"
         zdisp_cds.data['z_disp']=[ z.toFixed(4) ]
@@ -668,28 +984,32 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
             zlines[i].location = line_restwave[i] * waveshift_lines
             zline_labels[i].x = line_restwave[i] * waveshift_lines
         }
-        function shift_plotwave(cds_spec, waveshift) {
-            var data = cds_spec.data
-            var origwave = data['origwave']
-            var plotwave = data['plotwave']
-            if ( plotwave[0] != origwave[0] * waveshift ) { // Avoid redo calculation if not needed
-                for (var j=0; j<plotwave.length; j++) {
-                    plotwave[j] = origwave[j] * waveshift ;
-                }
-                cds_spec.change.emit()
-            }
-        }
-        
+        // Displayed wavelengths = origwave * scale factor (see wave_transform)
+        // CDS changes are emitted only if needed, so that transforms are recomputed
         var waveshift_spec = (waveframe_buttons.active == 0) ? 1 : 1/(1+z) ;
-        for(var i=0; i<spectra.length; i++) {
-            shift_plotwave(spectra[i], waveshift_spec)
+        if (waveshift_cds.data['spec'][0] != waveshift_spec) {
+            waveshift_cds.data['spec'][0] = waveshift_spec
+            for(var i=0; i<spectra.length; i++) {
+                spectra[i].change.emit()
+            }
+            if (coaddcam_spec) coaddcam_spec.change.emit()
         }
-        if (coaddcam_spec) shift_plotwave(coaddcam_spec, waveshift_spec)
         
-        // Update model wavelength array
+        // Update model wavelengths
         if(model) {
             var waveshift_model = (waveframe_buttons.active == 0) ? (1+z)/(1+zfit) : 1/(1+zfit) ;
-            shift_plotwave(model, waveshift_model)
+            if (waveshift_cds.data['model'][0] != waveshift_model) {
+                waveshift_cds.data['model'][0] = waveshift_model
+                model.change.emit()
+            }
+        }
+        
+        // Decimated spectra in main figure : the number of displayed points may change in rest frame
+        if (lod_sources) {
+            update_lod(lod_inputs, lod_sources, lod_keys, waveshift_cds, fig, lod_factors, false)
+            for(var i=0; i<lod_sources.length; i++) {
+                lod_sources[i].change.emit()
+            }
         }
         """)
 
@@ -1057,12 +1377,20 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
 
     #-----
     #- Main js code to update plot
-    with open(os.path.join(js_dir,"update_plot.js"), 'r') as f : update_plot_code = f.read()
+    #- smoothing_status : updated once smoothing is done by the Web Worker, to call update_plot again
+    smoothing_status = ColumnDataSource(dict(smoothed=[""])) if with_smoothing_worker else None
+    with open(os.path.join(js_dir,"load_sidecar.js"), 'r') as f : update_plot_code = f.read()
+    update_plot_code += update_lod_code
+    with open(os.path.join(js_dir,"smooth_data.js"), 'r') as f : update_plot_code += f.read()
+    with open(os.path.join(js_dir,"render_cache.js"), 'r') as f : update_plot_code += f.read()
+    with open(os.path.join(js_dir,"update_plot.js"), 'r') as f : update_plot_code += f.read()
     update_plot = CustomJS(
         args = dict(
             spectra = cds_spectra,
             coaddcam_spec = cds_coaddcam_spec,
+            coaddcam_maps = coaddcam_maps,
             model = cds_model,
+            model_templates = cds_model_templates,
             targetinfo = cds_targetinfo,
 #            target_info_div = target_info_div,
 ## BYPASS DIV
@@ -1083,12 +1411,23 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
             vi_class_labels = vi_class_labels,
             vi_issue_input = vi_issue_input,
             vi_z_input = vi_z_input, vi_category_select = vi_category_select,
-            vi_issue_slabels = vi_issue_slabels
+            vi_issue_slabels = vi_issue_slabels,
+            sidecar = sidecar_layout,
+            sidecar_sources = sidecar_sources,
+            sidecar_status = sidecar_status,
+            lod_inputs = lod_inputs, lod_sources = lod_sources, lod_keys = lod_keys,
+            waveshift_cds = waveshift_cds, lod_factors = _lod_factors,
+            smoothing_status = smoothing_status,
+            render_cache_size = render_cache_size
             ),
         code = update_plot_code
     )
     smootherslider.js_on_change('value', update_plot)
     ifiberslider.js_on_change('value', update_plot)
+    if sidecar :
+        sidecar_status.js_on_change('data', update_plot)
+    if with_smoothing_worker :
+        smoothing_status.js_on_change('data', update_plot)
 
 
     #-----
@@ -1172,19 +1511,26 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
         ncols_grid = 5 # TODO un-hardcode
         titles = None # TODO define
         miniplot_width = ( plot_width + (plot_height//2) ) // ncols_grid
-        thumb_grid = grid_thumbs(spectra, miniplot_width, x_range=(xmin,xmax), ncols_grid=ncols_grid, titles=titles)
+        thumb_grid, thumb_cells = grid_thumbs(spectra, miniplot_width, x_range=(xmin,xmax), ncols_grid=ncols_grid, titles=titles, context=context)
         tab1 = Panel(child = main_bokehsetup, title='Main viewer')
         tab2 = Panel(child = thumb_grid, title='Gallery')
         full_viewer.tabs=[ tab1, tab2 ]
         
         # Dirty trick : callback functions on thumbs need to be defined AFTER the full_viewer is implemented
         # Otherwise, at least one issue = no toolbar anymore for main fig. (apparently due to ifiberslider in callback args)
-        for i_spec in range(nspec) :
-            thumb_callback = CustomJS(args=dict(full_viewer=full_viewer, i_spec=i_spec, ifiberslider=ifiberslider), code="""
-            full_viewer.active = 0
-             ifiberslider.value = i_spec
+        # Single callback for the whole gallery : find the thumb cell containing the tap position
+        thumb_callback = CustomJS(args=dict(full_viewer=full_viewer, thumb_cells=thumb_cells, ifiberslider=ifiberslider), code="""
+            var cells = thumb_cells.data
+            for (var i=0; i<cells['i_spec'].length; i++) {
+                if (cb_obj.x >= cells['left'][i] && cb_obj.x < cells['right'][i] &&
+                    cb_obj.y >= cells['bottom'][i] && cb_obj.y < cells['top'][i]) {
+                    full_viewer.active = 0
+                    ifiberslider.value = cells['i_spec'][i]
+                    break
+                }
+            }
             """)
-            (thumb_grid.children[i_spec][0]).js_on_event(bokeh.events.Tap, thumb_callback)
+        thumb_grid.js_on_event(bokeh.events.Tap, thumb_callback)
 
     if notebook:
         bk.show(full_viewer)
@@ -1199,7 +1545,7 @@ def plotspectra(spectra, nspec=None, startspec=None, zcatalog=None, model_from_z
         ncols_grid = 5 # TODO un-hardcode
         titles = None # TODO define
         miniplot_width = ( plot_width + (plot_height//2) ) // ncols_grid
-        thumb_grid = grid_thumbs(spectra, miniplot_width, x_range=(xmin,xmax), ncols_grid=ncols_grid, titles=titles)
+        thumb_grid, thumb_cells = grid_thumbs(spectra, miniplot_width, x_range=(xmin,xmax), ncols_grid=ncols_grid, titles=titles, context=context)
         thumb_viewer = bk.Column(
             widgetbox( Div(text=
                            " <h3> Thumbnail gallery for DESI spectra in "+title+" </h3>" +
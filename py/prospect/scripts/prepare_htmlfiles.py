@@ -7,6 +7,7 @@ Write html index pages from existing pages/images produced by plotframes
 
 
 import os, glob, stat
+import json
 import argparse
 from desiutil.log import get_logger
 
@@ -38,11 +39,18 @@ def prepare_subdir(subdir, entry, template_index, template_vignette, target=None
 #     subsets = [ x[len(subdir+"/specviewer_"+pattern)+1:-5] for x in spec_pages ]
 #     subsets.sort(key=int)
     subsets = [str(x+1) for x in range(len(spec_pages))]
-    if with_thumbs : img_list = glob.glob( subdir+"/vignettes/*.png" )
+    if with_thumbs :
+        #- Vignettes are either individual png files, or gathered in atlas files (png + json index)
+        atlas_list = glob.glob( subdir+"/vignettes/*.atlas.json" )
+        atlas_index = dict()
+        for atlas_file in atlas_list :
+            with open(atlas_file, "r") as f :
+                atlas_index[os.path.basename(atlas_file)[:-len(".atlas.json")]] = json.load(f)
+        img_list = [ x for x in glob.glob( subdir+"/vignettes/*.png" ) if not x.endswith(".atlas.png") ]
     pp = [x for x in spec_pages if "_1.html" in x]
     pp=pp[0]
     basename = pp[len(subdir)+1:-7]
-    if with_thumbs : nspec = len(img_list)
+    if with_thumbs : nspec = len(img_list) + sum([ len(x['vignettes']) for x in atlas_index.values() ])
     else : nspec = 50 # TODO Ne pas laisser ca...
     if target is None and do_expo==False :
         pagetext = template_index.render(pixel=entry, subsets=subsets, nspec=nspec)
@@ -57,11 +65,13 @@ def prepare_subdir(subdir, entry, template_index, template_vignette, target=None
     if with_thumbs :
         for subset in subsets :
             img_sublist = [ os.path.basename(x) for x in img_list if entry+"_"+subset in x ]
-            pagetext = template_vignette.render(set=entry, i_subset=subset, n_subsets=len(subsets), imglist=img_sublist)
+            atlas = [ x for key, x in atlas_index.items() if key.endswith(entry+"_"+subset) ]
+            atlas = atlas[0] if len(atlas) > 0 else None
+            pagetext = template_vignette.render(set=entry, i_subset=subset, n_subsets=len(subsets), imglist=img_sublist, atlas=atlas)
             with open( os.path.join(subdir,"vignettelist_"+entry+"_"+subset+".html"), "w") as fh:
                 fh.write(pagetext)
                 fh.close()
-    for x in glob.glob(subdir+"/*.html") :
+    for x in glob.glob(subdir+"/*.html")+glob.glob(subdir+"/*.bin") :
         st = os.stat(x)
         os.chmod(x, st.st_mode | stat.S_IROTH) # "chmod a+r "
     st = os.stat(subdir)
@@ -70,7 +80,7 @@ def prepare_subdir(subdir, entry, template_index, template_vignette, target=None
         thedir = os.path.join(subdir,"vignettes")
         st = os.stat(thedir)
         os.chmod(thedir, st.st_mode | stat.S_IROTH | stat.S_IXOTH) # "chmod a+rx "
-        for x in glob.glob(subdir+"/vignettes/*.png") :
+        for x in glob.glob(subdir+"/vignettes/*.png")+glob.glob(subdir+"/vignettes/*.json") :
             st = os.stat(x)
             os.chmod(x, st.st_mode | stat.S_IROTH) # "chmod a+r "
 
@@ -31,7 +31,9 @@ def parse() :
     parser.add_argument('--tile', help='Name of single tile to be processed',type=str, default=None)
     parser.add_argument('--tile_list', help='ASCII file providing list of tiles', type=str, default=None)
     parser.add_argument('--sort_exposures', help='If tile-based, will still sort pages by exposures/spectrographs', action='store_true')
-    parser.add_argument('--nspecperfile', help='Number of spectra in each html page', type=int, default=50)
+    parser.add_argument('--nspecperfile', help='Number of spectra in each html page (in each binary file if --single_page)', type=int, default=50)
+    parser.add_argument('--single_page', help='Write a single html page per exposure/spectrograph or tile; spectra are stored in binary files of --nspecperfile spectra, loaded on demand by the browser (requires pages served over http)', action='store_true')
+    parser.add_argument('--compact_cds', help='Store spectra, noise and models as float32 instead of float64 in html pages (pages ~2x smaller)', action='store_true')
     parser.add_argument('--webdir', help='Base directory for webpages', type=str)
     parser.add_argument('--nmax_spectra', help='Stop the production of HTML pages once a given number of spectra are done', type=int, default=None)
     parser.add_argument('--frametype', help='Input frame category (currently sframe/cframe supported)', type=str, default='cframe')
@@ -105,9 +107,11 @@ def tile_db(specprod_dir, frametype='cframe', tile_subset=None, night_subset=Non
     return tiles_db    
     
 
-def page_subset_expo(fdir, exposure, frametype, spectrographs, html_dir, titlepage_prefix, mask, log, nspecperfile, snr_cut) :
+def page_subset_expo(fdir, exposure, frametype, spectrographs, html_dir, titlepage_prefix, mask, log, nspecperfile, snr_cut, single_page=False, compact_cds=False) :
     '''
     Running prospect from frames : loop over spectrographs for a given exposure
+        single_page : if True, one html page per spectrograph, with spectra stored in binary files of nspecperfile spectra
+        compact_cds : if True, arrays are stored as float32 in html pages
     '''
     
     nspec_done = 0
@@ -124,23 +128,27 @@ def page_subset_expo(fdir, exposure, frametype, spectrographs, html_dir, titlepa
         nspec_expo = spectra.num_spectra()
         log.info("Spectrograph number "+spectrograph_num+" : "+str(nspec_expo)+" spectra")
         sort_indices = np.argsort(spectra.fibermap["FIBER"])
-        nbpages = int(np.ceil((nspec_expo/nspecperfile)))
+        nspecperpage = nspec_expo if single_page else nspecperfile
+        nbpages = int(np.ceil((nspec_expo/nspecperpage)))
         for i_page in range(1,1+nbpages) :
 
             log.info(" * Page "+str(i_page)+" / "+str(nbpages))
-            the_indices = sort_indices[(i_page-1)*nspecperfile:i_page*nspecperfile]            
-            thespec = myspecselect.myspecselect(spectra, indices=the_indices)
+            the_indices = sort_indices[(i_page-1)*nspecperpage:i_page*nspecperpage]
+            thespec = myspecselect.myspecselect(spectra, indices=the_indices, view=True)
             titlepage = titlepage_prefix+"_spectro"+spectrograph_num+"_"+str(i_page)
             plotframes.plotspectra(thespec, with_noise=True, with_coaddcam=True, is_coadded=False, 
-                        title=titlepage, html_dir=html_dir, mask_type='CMX_TARGET', with_thumb_only_page=True)
+                        title=titlepage, html_dir=html_dir, mask_type='CMX_TARGET', with_thumb_only_page=(not single_page), compact_cds=compact_cds,
+                        with_thumb_tab=(not single_page), sidecar=single_page, sidecar_chunk=nspecperfile)
         nspec_done += nspec_expo
         
     return nspec_done
 
-def page_subset_tile(fdir, tile_db_subset, frametype, html_dir, titlepage_prefix, mask, log, nspecperfile, snr_cut) :
+def page_subset_tile(fdir, tile_db_subset, frametype, html_dir, titlepage_prefix, mask, log, nspecperfile, snr_cut, single_page=False, compact_cds=False) :
     '''
     Running prospect from frames : tile-based, do not separate pages per exposure.
         tile_db_subset : subset of tile_db, all with the same tile
+        single_page : if True, one html page per tile, with spectra stored in binary files of nspecperfile spectra
+        compact_cds : if True, arrays are stored as float32 in html pages
     '''
     
     tile = tile_db_subset['tile']
@@ -179,15 +187,17 @@ def page_subset_tile(fdir, tile_db_subset, frametype, html_dir, titlepage_prefix
     nspec_tile = all_spectra.num_spectra()
     log.info("Tile "+tile+" : "+str(nspec_tile)+" exposure-coadded spectra")
     sort_indices = np.argsort(all_spectra.fibermap["TARGETID"])
-    nbpages = int(np.ceil((nspec_tile/nspecperfile)))
+    nspecperpage = nspec_tile if single_page else nspecperfile
+    nbpages = int(np.ceil((nspec_tile/nspecperpage)))
     for i_page in range(1,1+nbpages) :
 
         log.info(" * Page "+str(i_page)+" / "+str(nbpages))
-        the_indices = sort_indices[(i_page-1)*nspecperfile:i_page*nspecperfile]            
-        thespec = myspecselect.myspecselect(all_spectra, indices=the_indices)
+        the_indices = sort_indices[(i_page-1)*nspecperpage:i_page*nspecperpage]
+        thespec = myspecselect.myspecselect(all_spectra, indices=the_indices, view=True)
         titlepage = titlepage_prefix+"_"+str(i_page)
         plotframes.plotspectra(thespec, with_noise=True, with_coaddcam=True, is_coadded=True, 
-                    title=titlepage, html_dir=html_dir, mask_type='CMX_TARGET', with_thumb_only_page=True)
+                    title=titlepage, html_dir=html_dir, mask_type='CMX_TARGET', with_thumb_only_page=(not single_page), compact_cds=compact_cds,
+                    with_thumb_tab=(not single_page), sidecar=single_page, sidecar_chunk=nspecperfile)
     nspec_done += nspec_tile
         
     return nspec_done
@@ -271,9 +281,9 @@ def main(args) :
             os.makedirs(html_dir)
         
         if page_sorting == 'tile' :
-            nspec_added = page_subset_tile(fdir, the_subset, args.frametype, html_dir, titlepage_prefix, args.mask, log, args.nspecperfile, args.snrcut)
+            nspec_added = page_subset_tile(fdir, the_subset, args.frametype, html_dir, titlepage_prefix, args.mask, log, args.nspecperfile, args.snrcut, single_page=args.single_page, compact_cds=args.compact_cds)
         else :
-            nspec_added = page_subset_expo(fdir, the_subset['exposure'], args.frametype, the_subset['spectrographs'], html_dir, titlepage_prefix, args.mask, log, args.nspecperfile, args.snrcut)
+            nspec_added = page_subset_expo(fdir, the_subset['exposure'], args.frametype, the_subset['spectrographs'], html_dir, titlepage_prefix, args.mask, log, args.nspecperfile, args.snrcut, single_page=args.single_page, compact_cds=args.compact_cds)
                     
         # Stop running if needed, only once a full exposure is completed
         nspec_done += nspec_added
@@ -21,14 +21,21 @@ import desispec.frame
 from prospect import myspecselect # special (to be edited)
 from prospect import plotframes
 from prospect import utils_specviewer
+from prospect import mymodels
 
 def parse() :
 
     parser = argparse.ArgumentParser(description='Create night-based html pages for the spectral viewer')
     parser.add_argument('--specprod_dir', help='overrides $DESI_SPECTRO_REDUX/$SPECPROD/', type=str, default=None)
-    parser.add_argument('--nspecperfile', help='Number of spectra in each html page', type=int, default=50)
+    parser.add_argument('--nspecperfile', help='Number of spectra in each html page (in each binary file if --single_page)', type=int, default=50)
+    parser.add_argument('--single_page', help='Write a single html page per file; spectra are stored in binary files of --nspecperfile spectra, loaded on demand by the browser (requires pages served over http)', action='store_true')
     parser.add_argument('--webdir', help='Base directory for webapges', type=str, default=None)
     parser.add_argument('--vignette_smoothing', help='Smoothing of the vignette images (-1 : no smoothing)', type=float, default=10)
+    parser.add_argument('--vignette_backend', help='Backend for vignette images : matplotlib, or raster (faster, no axis labels)', type=str, default='matplotlib')
+    parser.add_argument('--vignette_atlas', help='Write vignettes of each page in a single png file (+ json index), instead of one png per spectrum', action='store_true')
+    parser.add_argument('--compact_cds', help='Store spectra, noise and models as float32 instead of float64 in html pages (pages ~2x smaller)', action='store_true')
+    parser.add_argument('--sidecar', help='Store spectra in binary files next to html pages, loaded on demand by the browser (requires pages served over http)', action='store_true')
+    parser.add_argument('--model_dir', help='Directory where model spectra are stored, to be reused by later runs', type=str, default=None)
     args = parser.parse_args()
     return args
 
@@ -55,19 +62,27 @@ def main(args):
             spectra = desispec.io.read_spectra(f)
             zbfile = f.replace("tilespectra","zbest")
             zbest = Table.read(zbfile, 'ZBEST')
+            zcat_index = utils_specviewer.build_zcat_index(zbest)
+            #- Single-exposure spectra : one model per (target, exposure)
+            if args.model_dir is not None :
+                model_file = os.path.join(args.model_dir, os.path.basename(zbfile).replace(".fits","_models.npz"))
+                model_store = mymodels.ModelStore(model_file, zbest_file=zbfile, key_columns=('TARGETID','EXPID'))
+            else :
+                model_store = mymodels.ModelStore(key_columns=('TARGETID','EXPID'))
             # Handle several html pages per pixel : sort by TARGETID
             # NOTE : this way, individual spectra from the same target are together
             # Does it make sense ? (they have the same fit)
-            nbpages = int(np.ceil((spectra.num_spectra()/args.nspecperfile)))
+            nspecperpage = spectra.num_spectra() if args.single_page else args.nspecperfile
+            nbpages = int(np.ceil((spectra.num_spectra()/nspecperpage)))
             sort_indices = np.argsort(spectra.fibermap["TARGETID"], kind='mergesort') # keep order of equal elts
         
             for i_page in range(1,1+nbpages) :
             
                 log.info(" * Page "+str(i_page)+" / "+str(nbpages))
-                the_indices = sort_indices[(i_page-1)*args.nspecperfile:i_page*args.nspecperfile]
-                thespec = myspecselect.myspecselect(spectra, indices=the_indices)
-                thezb, kk = utils_specviewer.match_zcat_to_spectra(zbest,thespec)
-                model = plotframes.create_model(thespec, thezb)
+                the_indices = sort_indices[(i_page-1)*nspecperpage:i_page*nspecperpage]
+                thespec = myspecselect.myspecselect(spectra, indices=the_indices, view=True)
+                thezb, kk = utils_specviewer.match_zcat_to_spectra(zbest, thespec, zcat_index=zcat_index)
+                model = model_store.get_models(thespec, thezb)
                 ### No VI results to display by default
                 # vifile = os.environ['HOME']+"/prospect/vilist_prototype.fits"
                 # vidata = utils_specviewer.match_vi_targets(vifile, thespec.fibermap["TARGETID"])
@@ -77,8 +92,10 @@ def main(args):
                     os.makedirs(html_dir)
                     os.mkdir(html_dir+"/vignettes")
             
-                plotframes.plotspectra(thespec, zcatalog=thezb, vidata=None, model=model, title=titlepage, html_dir=html_dir, is_coadded=False)
-                for i_spec in range(thespec.num_spectra()) :
-                    saveplot = html_dir+"/vignettes/night"+thenight+"_"+file_label+"_"+str(i_page)+"_"+str(i_spec)+".png"
-                    utils_specviewer.miniplot_spectrum(thespec, i_spec, model=model, saveplot=saveplot, smoothing = args.vignette_smoothing)
+                context = utils_specviewer.ViewerContext(thespec)
+                plotframes.plotspectra(thespec, zcatalog=thezb, model_from_zcat=False, vidata=None, model=model, title=titlepage, html_dir=html_dir, is_coadded=False, context=context, compact_cds=args.compact_cds, sidecar=(args.sidecar or args.single_page), sidecar_chunk=args.nspecperfile, with_thumb_tab=(not args.single_page))
+                saveplots = [ html_dir+"/vignettes/night"+thenight+"_"+file_label+"_"+str(i_page)+"_"+str(i_spec)+".png" for i_spec in range(thespec.num_spectra()) ]
+                atlas_file = html_dir+"/vignettes/night"+thenight+"_"+file_label+"_"+str(i_page)+".atlas.png" if args.vignette_atlas else None
+                utils_specviewer.miniplot_spectra(thespec, saveplots, model=model, smoothing = args.vignette_smoothing, context=context, backend=args.vignette_backend, atlas_file=atlas_file)
+            model_store.save()
 
@@ -23,6 +23,7 @@ import desispec.frame
 from prospect import myspecselect # special (to be edited)
 from prospect import plotframes
 from prospect import utils_specviewer
+from prospect import mymodels
 
 def parse() :
 
@@ -33,12 +34,20 @@ def parse() :
     parser.add_argument('--gcut', help='Select only objects in a given [dereddened] g-mag range (eg --gcut 22 22.5)', nargs='+', type=float, default=None)
     parser.add_argument('--rcut', help='Select only objects in a given [dereddened] r-mag range (eg --rcut 18 19.5)', nargs='+', type=float, default=None)
     parser.add_argument('--chi2cut', help='Select only objects with Delta_chi2 (from pipeline fit) in a given range (eg --chi2cut 40 100)', nargs='+', type=float, default=None)
-    parser.add_argument('--nspecperfile', help='Number of spectra in each html page', type=int, default=50)
+    parser.add_argument('--selection', help='Selection expression on fibermap/scores/zbest columns (eg "DESI_TARGET & ELG and 40<DELTACHI2<100")', type=str, default=None)
+    parser.add_argument('--nspecperfile', help='Number of spectra in each html page (in each binary file if --single_page)', type=int, default=50)
+    parser.add_argument('--single_page', help='Write a single html page per pixel; spectra are stored in binary files of --nspecperfile spectra, loaded on demand by the browser (requires pages served over http)', action='store_true')
     parser.add_argument('--webdir', help='Base directory for webpages', type=str, default=None)
     parser.add_argument('--vignette_smoothing', help='Smoothing of the vignette images (-1 : no smoothing)', type=float, default=10)
+    parser.add_argument('--vignette_backend', help='Backend for vignette images : matplotlib, or raster (faster, no axis labels)', type=str, default='matplotlib')
+    parser.add_argument('--vignette_atlas', help='Write vignettes of each page in a single png file (+ json index), instead of one png per spectrum', action='store_true')
     parser.add_argument('--mask_type', help='Mask category : DESI_TARGET,SV1_DESI_TARGET,CMX_TARGET', type=str, default='DESI_TARGET')
     parser.add_argument('--random_pixels', help='Process pixels in random order', action='store_true')
     parser.add_argument('--nmax_spectra', help='Stop the production of HTML pages once a given number of spectra are done', type=int, default=None)
+    parser.add_argument('--sidecar', help='Store spectra in binary files next to html pages, loaded on demand by the browser (requires pages served over http)', action='store_true')
+    parser.add_argument('--compact_cds', help='Store spectra, noise and models as float32 instead of float64 in html pages (pages ~2x smaller)', action='store_true')
+    parser.add_argument('--compact_model', help='Store template basis vectors instead of model spectra in html pages', action='store_true')
+    parser.add_argument('--model_dir', help='Directory where model spectra are stored, to be reused by later runs', type=str, default=None)
     args = parser.parse_args()
     return args
 
@@ -67,7 +76,7 @@ def main(args) :
         log.info("Working on pixel "+pixel)
         thefile = desispec.io.findfile('spectra', groupname=int(pixel), specprod_dir=specprod_dir)
         individual_spectra = desispec.io.read_spectra(thefile)
-        spectra = plotframes.coadd_targets(individual_spectra)
+        spectra = utils_specviewer.coadd_targets(individual_spectra)
         zbfile = thefile.replace('spectra-64-', 'zbest-64-')
         if os.path.isfile(zbfile) :
             zbest = Table.read(zbfile, 'ZBEST')
@@ -75,22 +84,30 @@ def main(args) :
             log.info("No associated zbest file found : skipping pixel")
             continue
         
+        if args.model_dir is not None :
+            model_file = os.path.join(args.model_dir, "models-64-"+pixel+".npz")
+            model_store = mymodels.ModelStore(model_file, zbest_file=zbfile)
+        else :
+            model_store = mymodels.ModelStore()
+        
+        zcat_index = utils_specviewer.build_zcat_index(zbest)
         spectra = utils_specviewer.specviewer_selection(spectra, log=log,
                         mask=args.mask, mask_type=args.mask_type, gmag_cut=args.gcut, rmag_cut=args.rcut, 
-                        chi2cut=args.chi2cut, zbest=zbest)
+                        chi2cut=args.chi2cut, zbest=zbest, expression=args.selection, zcat_index=zcat_index)
         if spectra == 0 : continue
 
         # Handle several html pages per pixel : sort by TARGETID
         # TODO - Find a more useful sort ?
-        nbpages = int(np.ceil((spectra.num_spectra()/args.nspecperfile)))
+        nspecperpage = spectra.num_spectra() if args.single_page else args.nspecperfile
+        nbpages = int(np.ceil((spectra.num_spectra()/nspecperpage)))
         sort_indices = np.argsort(spectra.fibermap["TARGETID"])
         
         for i_page in range(1,1+nbpages) :
             
             log.info(" * Page "+str(i_page)+" / "+str(nbpages))
-            the_indices = sort_indices[(i_page-1)*args.nspecperfile:i_page*args.nspecperfile]
-            thespec = myspecselect.myspecselect(spectra, indices=the_indices)
-            thezb, kk = utils_specviewer.match_zcat_to_spectra(zbest,thespec)
+            the_indices = sort_indices[(i_page-1)*nspecperpage:i_page*nspecperpage]
+            thespec = myspecselect.myspecselect(spectra, indices=the_indices, view=True)
+            thezb, kk = utils_specviewer.match_zcat_to_spectra(zbest, thespec, zcat_index=zcat_index)
             ### No VI results to display by default
             # VI "catalog" - location to define later ..
             # vifile = os.environ['HOME']+"/prospect/vilist_prototype.fits"
@@ -104,17 +121,18 @@ def main(args) :
                 titlepage = "chi2cut-"+str(args.chi2cut[0])+"-"+str(args.chi2cut[1])+"_"+titlepage
             if args.mask is not None :
                 titlepage = args.mask+"_"+titlepage
-            model = plotframes.create_model(thespec, thezb)
             html_dir = os.path.join(webdir,"pix"+pixel)
             if not os.path.exists(html_dir) : 
                 os.makedirs(html_dir)
                 os.mkdir(html_dir+"/vignettes")
             
-            plotframes.plotspectra(thespec, zcatalog=zbest, model_from_zcat=True, vidata=None, model=None, title=titlepage, html_dir=html_dir, is_coadded=True, mask_type=args.mask_type)
-            for i_spec in range(thespec.num_spectra()) :
-                saveplot = html_dir+"/vignettes/pix"+pixel+"_"+str(i_page)+"_"+str(i_spec)+".png"
-                utils_specviewer.miniplot_spectrum(thespec, i_spec, model=model, saveplot=saveplot, smoothing = args.vignette_smoothing)
+            context = utils_specviewer.ViewerContext(thespec)
+            plotframes.plotspectra(thespec, zcatalog=thezb, model_from_zcat=True, model_store=model_store, vidata=None, title=titlepage, html_dir=html_dir, is_coadded=True, mask_type=args.mask_type, compact_model=args.compact_model, context=context, compact_cds=args.compact_cds, sidecar=(args.sidecar or args.single_page), sidecar_chunk=args.nspecperfile, with_thumb_tab=(not args.single_page))
+            saveplots = [ html_dir+"/vignettes/pix"+pixel+"_"+str(i_page)+"_"+str(i_spec)+".png" for i_spec in range(thespec.num_spectra()) ]
+            atlas_file = html_dir+"/vignettes/pix"+pixel+"_"+str(i_page)+".atlas.png" if args.vignette_atlas else None
+            utils_specviewer.miniplot_spectra(thespec, saveplots, zcatalog=thezb, model_store=model_store, smoothing = args.vignette_smoothing, context=context, backend=args.vignette_backend, atlas_file=atlas_file)
             nspec_done += thespec.num_spectra()
+        model_store.save()
         
         # Stop running if needed, only once a full pixel is completed
         if args.nmax_spectra is not None :
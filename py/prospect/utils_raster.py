@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal rasterizer for spectrum vignettes, without matplotlib
+
+Polylines are drawn (by pixel columns, with anti-aliasing) into a numpy RGB buffer, which is written
+as a PNG file with zlib. The layout mimics the default matplotlib figure used by
+utils_specviewer.miniplot_spectra (same image size, axes position and autoscaling),
+without tick labels.
+Vignettes of a page can also be gathered into a single png "atlas" (see write_atlas).
+"""
+
+import os
+import json
+import struct
+import zlib
+
+import numpy as np
+
+#- Colors used in vignettes, see utils_specviewer._vignette_data
+_named_colors = {
+    'k' : '#000000',
+    'black' : '#000000',
+    'white' : '#ffffff',
+    'red' : '#ff0000',
+    'maroon' : '#800000',
+    'green' : '#008000',
+    'blue' : '#0000ff',
+}
+
+
+def color_to_rgb(color) :
+    '''
+    Returns (r, g, b) floats in [0,1] from '#rrggbb' or a few color names
+    '''
+    color = _named_colors.get(color, color)
+    if not (color.startswith('#') and len(color)==7) :
+        raise ValueError("Unsupported color "+str(color))
+    return tuple([ int(color[i:i+2], 16)/255. for i in [1, 3, 5] ])
+
+
+def write_png(filename, image) :
+    '''
+    Writes 8-bit RGB png file
+    image : 3D[height, width, 3] uint8 array
+    '''
+    height, width, nchan = image.shape
+    assert nchan == 3 and image.dtype == np.uint8
+    #- Each row is preceded by its filter type (0 : none)
+    raw = np.zeros((height, 1+3*width), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, 3*width)
+
+    def chunk(tag, data) :
+        return (struct.pack('>I', len(data)) + tag + data
+                + struct.pack('>I', zlib.crc32(tag+data) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    with open(filename, 'wb') as f :
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', header))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def write_atlas(filename, images, names, ncols=10) :
+    '''
+    Writes a set of images as a single png "sprite sheet" (atlas), on a grid of ncols columns,
+    and a json file (same name, with .json instead of .png) giving the position of each image :
+        { "image" : basename of filename, "width" : w, "height" : h,
+          "vignettes" : [ { "name" : name, "x" : x, "y" : y }, ... ] }
+    images : list of 3D[h, w, 3] uint8 arrays, all with the same shape
+    names : list of names identifying each image (eg. png file names in non-atlas mode)
+    Returns the json file name
+    '''
+    assert len(images) == len(names) and len(images) > 0
+    assert filename.endswith('.png')
+    height, width, nchan = images[0].shape
+    ncols = min(ncols, len(images))
+    nrows = (len(images)+ncols-1) // ncols
+    atlas = np.full((nrows*height, ncols*width, 3), 255, dtype=np.uint8)
+    vignettes = []
+    for i, (image, name) in enumerate(zip(images, names)) :
+        x, y = (i % ncols)*width, (i // ncols)*height
+        atlas[y:y+height, x:x+width] = image
+        vignettes.append( dict(name=name, x=x, y=y) )
+    write_png(filename, atlas)
+
+    json_file = filename[:-4]+'.json'
+    with open(json_file, 'w') as f :
+        json.dump( dict(image=os.path.basename(filename), width=width, height=height, vignettes=vignettes), f )
+    return json_file
+
+
+def draw_polyline(coverage, x, y, width=1.) :
+    '''
+    Adds the polyline (x, y) (pixel coordinates, x increasing) to the coverage map 2D[height, width],
+    coverage values being in [0,1]. NaN values break the line.
+    The line is drawn by pixel columns : in each column, it covers the vertical span between
+    the lowest and highest points of the line within the column (segments being cut at column
+    boundaries), widened by width/2 on each side, with anti-aliased ends.
+    The cost is O(number of points + number of columns), whatever the line's extent in pixels.
+    '''
+    height, nx = coverage.shape
+    ok = np.isfinite(x) & np.isfinite(y)
+    seg = ok[:-1] & ok[1:]
+    x0, y0, x1, y1 = x[:-1][seg], y[:-1][seg], x[1:][seg], y[1:][seg]
+    #- Points where segments cross column boundaries : they belong to both adjacent columns
+    c0 = np.floor(x0).astype(int)
+    ncross = np.floor(x1).astype(int) - c0
+    icross = np.repeat(np.arange(ncross.size), ncross)
+    kcross = c0[icross] + 1 + np.arange(icross.size) - np.repeat(np.cumsum(ncross)-ncross, ncross)
+    ycross = y0[icross] + (kcross-x0[icross]) * ((y1-y0)/(x1-x0))[icross]
+    cols = np.concatenate([ np.floor(x[ok]).astype(int), kcross, kcross-1 ])
+    ys = np.concatenate([ y[ok], ycross, ycross ])
+    inside = (cols >= 0) & (cols < nx)
+    cols, ys = cols[inside], ys[inside]
+    if cols.size == 0 : return
+
+    #- Vertical span of the line in each column
+    ymin = np.full(nx, np.inf)
+    ymax = np.full(nx, -np.inf)
+    np.minimum.at(ymin, cols, ys)
+    np.maximum.at(ymax, cols, ys)
+    drawn = np.isfinite(ymin)
+    lo = np.where(drawn, ymin-0.5*width, 0)
+    hi = np.where(drawn, ymax+0.5*width, 0)
+    #- Coverage of pixel row r = length of [r, r+1] within [lo, hi]
+    rows = np.arange(height, dtype=np.float64)[:, np.newaxis]
+    cover = np.minimum(rows+1, hi) - np.maximum(rows, lo)
+    np.clip(cover, 0, 1, out=cover)
+    np.maximum(coverage, cover, out=coverage)
+
+
+class RasterVignetteRenderer(object):
+    '''
+    Draws vignettes into numpy buffers, with the same interface as
+    utils_specviewer._MplVignetteRenderer (curves, ylims from utils_specviewer._vignette_data)
+    '''
+    def __init__(self, curves, ylims, figsize=(6.4,4.8), dpi=50, axes_box=(0.125, 0.11, 0.9, 0.88)) :
+        self.curves = curves
+        self.ylims = ylims
+        self.width = int(round(figsize[0]*dpi))
+        self.height = int(round(figsize[1]*dpi))
+        #- Axes box in pixels (left, bottom, right, top), from figure fractions
+        self.box = ( int(round(axes_box[0]*self.width)), int(round((1-axes_box[1])*self.height)),
+                     int(round(axes_box[2]*self.width)), int(round((1-axes_box[3])*self.height)) )
+        self.colors = [ np.array(color_to_rgb(curve['color'])) for curve in curves ]
+        self.margin = 0.05 # relative margin around data, as in matplotlib
+
+    def _limits(self, values) :
+        vmin, vmax = np.nanmin(values), np.nanmax(values)
+        if not np.isfinite(vmin) : return (-0.05, 0.05)
+        if vmax == vmin :
+            delta = abs(vmin)*0.05 if vmin != 0 else 0.05
+            return (vmin-delta, vmax+delta)
+        delta = self.margin*(vmax-vmin)
+        return (vmin-delta, vmax+delta)
+
+    def render_image(self, i) :
+        '''
+        Returns vignette i as 3D[height, width, 3] uint8 array
+        '''
+        left, bottom, right, top = self.box
+        nx, ny = right-left, bottom-top
+
+        #- Data limits, as autoscale in matplotlib (+ fixed y range if available)
+        xvals = np.concatenate([ curve['wave'][np.isfinite(curve['flux'][i])] for curve in self.curves ])
+        if xvals.size == 0 : xvals = np.array([0.])
+        xmin, xmax = self._limits(xvals)
+        if self.ylims is not None :
+            ymin, ymax = self.ylims[0][i], self.ylims[1][i]
+            if ymin == ymax : ymin, ymax = self._limits(np.array([ymin]))
+        else :
+            ymin, ymax = self._limits(np.concatenate([ curve['flux'][i] for curve in self.curves ]))
+
+        #- Curves are composited within the axes box only, the rest of the image being white
+        sub = np.ones((ny, nx, 3))
+        for curve, color in zip(self.curves, self.colors) :
+            coverage = np.zeros((ny, nx))
+            px = (curve['wave']-xmin)/(xmax-xmin)*nx
+            py = (ymax-curve['flux'][i])/(ymax-ymin)*ny
+            draw_polyline(coverage, px, py, width=1.5)
+            coverage = coverage[:, :, np.newaxis]
+            sub += coverage*(color-sub)
+
+        image = np.full((self.height, self.width, 3), 255, dtype=np.uint8)
+        image[top:bottom, left:right] = np.round(sub*255)
+        #- Axes frame
+        image[top, left:right+1] = 0
+        image[bottom, left:right+1] = 0
+        image[top:bottom+1, left] = 0
+        image[top:bottom+1, right] = 0
+
+        return image
+
+    def render(self, i, filename) :
+        write_png(filename, self.render_image(i))
+
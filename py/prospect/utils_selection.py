@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Selection of spectra from meta-data, used by utils_specviewer.specviewer_selection
+
+A selection expression is a python-like boolean expression on columns of
+the fibermap, the scores and the (matched) zbest table, eg :
+    "DESI_TARGET & ELG and 40 < DELTACHI2 < 100"
+    "(CMX_TARGET & SV0_QSO or GMAG < 21) and not ZWARN"
+Supported : and/or/not, (chained) comparisons, "&" between a target mask column
+and a bit name (or an integer), numbers and strings.
+Derived columns GMAG, RMAG, ZMAG (dereddened magnitudes, 0 if flux <= 0) are available.
+Expressions are parsed with the ast module, and are never evaluated by python itself.
+"""
+
+import ast
+
+import numpy as np
+
+from desitarget.targetmask import desi_mask, bgs_mask, mws_mask
+from desitarget.cmx.cmx_targetmask import cmx_mask
+from desitarget.sv1.sv1_targetmask import desi_mask as sv1_desi_mask
+from desitarget.sv1.sv1_targetmask import bgs_mask as sv1_bgs_mask
+from desitarget.sv1.sv1_targetmask import mws_mask as sv1_mws_mask
+
+#- Bitmasks used to interpret bit names in "COLUMN & BITNAME"
+_target_masks = {
+    'DESI_TARGET' : desi_mask,
+    'BGS_TARGET' : bgs_mask,
+    'MWS_TARGET' : mws_mask,
+    'SV1_DESI_TARGET' : sv1_desi_mask,
+    'SV1_BGS_TARGET' : sv1_bgs_mask,
+    'SV1_MWS_TARGET' : sv1_mws_mask,
+    'CMX_TARGET' : cmx_mask
+}
+
+_compare_ops = {
+    ast.Lt : np.less,
+    ast.LtE : np.less_equal,
+    ast.Gt : np.greater,
+    ast.GtE : np.greater_equal,
+    ast.Eq : np.equal,
+    ast.NotEq : np.not_equal
+}
+
+
+def dereddened_mag(fibermap, band) :
+    '''
+    Returns array of dereddened AB magnitudes in a given band ('G', 'R', 'Z'), from
+    fibermap['FLUX_'+band] and fibermap['MW_TRANSMISSION_'+band]. Set to 0 if flux <= 0.
+    '''
+    flux = np.asarray(fibermap['FLUX_'+band], dtype=np.float64)
+    transmission = np.asarray(fibermap['MW_TRANSMISSION_'+band], dtype=np.float64)
+    mag = np.zeros(len(flux))
+    w, = np.where( (flux>0) & (transmission>0) )
+    mag[w] = -2.5*np.log10(flux[w]/transmission[w])+22.5
+    return mag
+
+
+class SelectionColumns(object):
+    '''
+    Read-only access to the columns of spectra.fibermap, spectra.scores and zcatalog,
+    all row-matched to spectra. Columns are extracted at first access only;
+    zcatalog is matched to spectra only if one of its columns is needed.
+    '''
+    def __init__(self, spectra, zcatalog=None, zcat_index=None) :
+        self.spectra = spectra
+        self.zcatalog = zcatalog
+        self.zcat_index = zcat_index
+        self._matched_zcat = None
+        self._columns = dict()
+
+    def _zcat(self) :
+        if self._matched_zcat is None :
+            from prospect import utils_specviewer
+            self._matched_zcat, dummy = utils_specviewer.match_zcat_to_spectra(self.zcatalog,
+                                            self.spectra, zcat_index=self.zcat_index)
+        return self._matched_zcat
+
+    def __contains__(self, name) :
+        try:
+            self[name]
+        except KeyError :
+            return False
+        return True
+
+    def __getitem__(self, name) :
+        if name in self._columns :
+            return self._columns[name]
+        fibermap = self.spectra.fibermap
+        scores = self.spectra.scores
+        if name in fibermap.colnames :
+            column = np.asarray(fibermap[name])
+        elif scores is not None and name in scores.keys() :
+            column = np.asarray(scores[name])
+        elif self.zcatalog is not None and name in self.zcatalog.colnames :
+            column = np.asarray(self._zcat()[name])
+        elif name in ['GMAG', 'RMAG', 'ZMAG'] and 'FLUX_'+name[0] in fibermap.colnames :
+            column = dereddened_mag(fibermap, name[0])
+        else :
+            raise KeyError(name)
+        if column.dtype.kind == 'S' : column = column.astype(str)
+        self._columns[name] = column
+        return column
+
+
+class SelectionExpression(object):
+    '''
+    Compiled selection expression, see module docstring for the syntax.
+    Raises ValueError at construction if the expression is not valid.
+    '''
+    def __init__(self, expression) :
+        self.expression = expression
+        try:
+            self._tree = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError as err :
+            raise ValueError("Invalid selection expression '"+expression+"' : "+str(err))
+        self._check(self._tree)
+
+    def _check(self, node) :
+        '''
+        Only a limited set of python syntax is accepted
+        '''
+        if isinstance(node, ast.BoolOp) :
+            for x in node.values : self._check(x)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub)) :
+            self._check(node.operand)
+        elif isinstance(node, ast.Compare) :
+            if not all([ type(op) in _compare_ops for op in node.ops ]) :
+                raise ValueError("Unsupported comparison in selection expression '"+self.expression+"'")
+            for x in [node.left]+node.comparators : self._check(x)
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitAnd) :
+            self._check(node.left)
+            if not isinstance(node.right, (ast.Name, ast.Constant)) :
+                raise ValueError("Right-hand side of '&' must be a bit name or an integer, in '"+self.expression+"'")
+            self._check(node.right)
+        elif isinstance(node, ast.Name) :
+            pass
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str)) :
+            pass
+        else :
+            raise ValueError("Unsupported syntax '"+ast.dump(node)+"' in selection expression '"+self.expression+"'")
+
+    def _bits(self, colname, node) :
+        '''
+        Bit value on the right-hand side of "colname & ..."
+        '''
+        if isinstance(node, ast.Constant) :
+            return node.value
+        if colname not in _target_masks :
+            raise ValueError("Bit name "+node.id+" used with column "+str(colname)+", which is not a target mask")
+        bitmask = _target_masks[colname]
+        if node.id not in bitmask.names() :
+            raise ValueError("Unknown bit name "+node.id+" for "+colname)
+        return bitmask[node.id]
+
+    def _eval(self, node, columns, nspec) :
+        if isinstance(node, ast.BoolOp) :
+            masks = [ self._as_bool(self._eval(x, columns, nspec)) for x in node.values ]
+            if isinstance(node.op, ast.And) : return np.logical_and.reduce(masks)
+            return np.logical_or.reduce(masks)
+        if isinstance(node, ast.UnaryOp) :
+            if isinstance(node.op, ast.Not) :
+                return ~self._as_bool(self._eval(node.operand, columns, nspec))
+            return -self._eval(node.operand, columns, nspec)
+        if isinstance(node, ast.Compare) :
+            result = np.ones(nspec, dtype=bool)
+            left = self._eval(node.left, columns, nspec)
+            for op, comparator in zip(node.ops, node.comparators) :
+                right = self._eval(comparator, columns, nspec)
+                result &= _compare_ops[type(op)](left, right)
+                left = right
+            return result
+        if isinstance(node, ast.BinOp) :
+            colname = node.left.id if isinstance(node.left, ast.Name) else None
+            return (self._eval(node.left, columns, nspec) & self._bits(colname, node.right)) != 0
+        if isinstance(node, ast.Name) :
+            if node.id not in columns :
+                raise ValueError("Unknown column "+node.id+" in selection expression '"+self.expression+"'")
+            return columns[node.id]
+        return node.value
+
+    @staticmethod
+    def _as_bool(values) :
+        values = np.asarray(values)
+        if values.dtype == bool : return values
+        return values != 0
+
+    def evaluate(self, columns, nspec) :
+        '''
+        Returns boolean array (size nspec) of selected spectra
+        columns : SelectionColumns (or any dict-like giving row-matched column arrays)
+        '''
+        result = self._as_bool(self._eval(self._tree, columns, nspec))
+        return np.broadcast_to(result, (nspec,)).copy()
+
@@ -4,15 +4,13 @@
 Utility functions for prospect
 """
 
+import os
 import numpy as np
 import astropy.io.fits
 from astropy.table import Table, vstack
 import scipy.ndimage.filters
 
-
-import matplotlib
-matplotlib.use('Agg') # No DISPLAY
-import matplotlib.pyplot as plt
+#- matplotlib is imported only when needed, see _vignette_renderer()
 
 from desiutil.log import get_logger
 import desispec.spectra
@@ -22,6 +20,7 @@ from desitarget.cmx.cmx_targetmask import cmx_mask
 from desitarget.sv1.sv1_targetmask import desi_mask as sv1_desi_mask
 from prospect import mycoaddcam
 from prospect import myspecselect
+from prospect import utils_selection
 
 _vi_flags = [
     # Definition of VI flags
@@ -135,101 +134,409 @@ def merge_vi(mastervifile, newvifile) :
     log.info("Updated master VI file : "+mastervifile+" (now "+str(len(mergedvi))+" entries).")
 
 
-def match_zcat_to_spectra(zcat_in, spectra) :
+def build_zcat_index(zcat) :
+    '''
+    Returns index sorting zcat by TARGETID (then by ZNUM, if available), to be used
+    by match_zcat_to_spectra. It can be computed once per zcat, and then used to match
+    any number of Spectra objects.
+    '''
+    if 'ZNUM' in zcat.colnames :
+        return np.lexsort((zcat['ZNUM'], zcat['TARGETID']))
+    return np.argsort(zcat['TARGETID'], kind='mergesort') # keep order of equal elts
+
+
+def match_zcat_to_spectra(zcat_in, spectra, all_znum=False, zcat_index=None) :
     '''
     zcat_in : astropy Table from redshift fitter
     creates a new astropy Table whose rows match the targetids of input spectra
-    also returns the corresponding list of indices
-    '''
-    zcat_out = Table(dtype=zcat_in.dtype)
-    index_list = list()
-    for i_spec in range(spectra.num_spectra()) :
-        ww, = np.where((zcat_in['TARGETID'] == spectra.fibermap['TARGETID'][i_spec]))
-        if len(ww)<1 : raise RuntimeError("zcat table cannot match spectra.")
-        zcat_out.add_row(zcat_in[ww[0]])
-        index_list.append(ww[0])
+    also returns the corresponding array of indices
+    all_znum : if False, for each spectrum keep only the first entry (lowest ZNUM if available)
+        if True, keep all entries : output rows are then grouped by spectrum, and sorted by ZNUM
+    zcat_index : output of build_zcat_index(zcat_in), if available
+    '''
+    if zcat_index is None : zcat_index = build_zcat_index(zcat_in)
+    sorted_targetids = np.asarray(zcat_in['TARGETID'])[zcat_index]
+    targetids = np.asarray(spectra.fibermap['TARGETID'])
+    i_first = np.searchsorted(sorted_targetids, targetids, side='left')
+    i_last = np.searchsorted(sorted_targetids, targetids, side='right')
+    if np.any(i_last == i_first) : raise RuntimeError("zcat table cannot match spectra.")
+    if all_znum :
+        nentries = i_last - i_first
+        offsets = np.arange(np.sum(nentries)) - np.repeat(np.cumsum(nentries)-nentries, nentries)
+        index_list = zcat_index[np.repeat(i_first, nentries) + offsets]
+    else :
+        index_list = zcat_index[i_first]
+    zcat_out = zcat_in[index_list]
     return (zcat_out, index_list)
 
 
+def _ivar_to_noise(ivar, default=0.) :
+    '''
+    Returns noise array 1/sqrt(ivar), set to default where ivar <= 0
+    '''
+    noise = np.full(ivar.shape, default, dtype=np.float64)
+    w = (ivar > 0)
+    noise[w] = 1/np.sqrt(ivar[w])
+    return noise
+
+
+class ViewerContext(object):
+    '''
+    Computations on a set of spectra (typically one html page) shared by all consumers :
+    CDS builders, thumbnail grid, matplotlib vignettes.
+    Each quantity is computed at first request only.
+    Returned arrays are shared between consumers : they must NOT be modified in place.
+    '''
+    def __init__(self, spectra) :
+        self.spectra = spectra
+        self._masked = False
+        self._coaddcam = None
+        self._coaddcam_noise = None
+        self._noise = dict()
+        self._matched_zcat = dict()
+        self._model = None
+        self._stats = None
+
+    def mask_bad_pixels(self) :
+        '''
+        Sets flux of masked bins (ivar == 0 or mask != 0) to NaN, in place, so that they are not plotted.
+        Done only once, before any camera coaddition.
+        '''
+        if self._masked : return
+        for band in self.spectra.bands :
+            bad = (self.spectra.ivar[band] == 0.0)
+            if self.spectra.mask is not None : bad |= (self.spectra.mask[band] != 0)
+            self.spectra.flux[band][bad] = np.nan
+        self._masked = True
+
+    def noise(self, band) :
+        '''
+        Noise array for a given band, 2D[nspec, nwave], 0 where ivar is 0
+        '''
+        if band not in self._noise :
+            self._noise[band] = _ivar_to_noise(self.spectra.ivar[band])
+        return self._noise[band]
+
+    def coaddcam(self) :
+        '''
+        Camera-coadded spectra (wave, flux, ivar), see mycoaddcam
+        '''
+        if self._coaddcam is None :
+            self.mask_bad_pixels()
+            self._coaddcam = mycoaddcam.mycoaddcam(self.spectra)
+        return self._coaddcam
+
+    def coaddcam_noise(self) :
+        '''
+        Noise of camera-coadded spectra, 2D[nspec, nwave], 1 where ivar is 0
+        '''
+        if self._coaddcam_noise is None :
+            self._coaddcam_noise = _ivar_to_noise(self.coaddcam()[2], default=1.)
+        return self._coaddcam_noise
+
+    def stats(self) :
+        '''
+        Per-spectrum statistics, computed for all spectra at once. Returns a dict of 1D[nspec] arrays :
+          - flux_ymin, flux_ymax : y-range of unsmoothed fluxes, as computed in update_plot.js
+            (1% and 99% percentiles in each band, see get_y_minmax ; range includes 0)
+          - snr_<band> : median S/N per pixel in each band, over unmasked pixels (0 if none)
+          - masked_frac : fraction of masked pixels (ivar == 0 or mask != 0), all bands together
+        '''
+        if self._stats is None :
+            self.mask_bad_pixels()
+            nspec = self.spectra.num_spectra()
+            stats = dict(flux_ymin=np.zeros(nspec), flux_ymax=np.zeros(nspec))
+            nmasked = np.zeros(nspec)
+            npix = 0
+            for band in self.spectra.bands :
+                flux = self.spectra.flux[band]
+                ymin, ymax = _y_minmax_rows(0.01, 0.99, flux)
+                stats['flux_ymin'] = np.minimum(stats['flux_ymin'], ymin)
+                stats['flux_ymax'] = np.maximum(stats['flux_ymax'], ymax)
+                #- Masked pixels have NaN flux (see mask_bad_pixels)
+                good = np.isfinite(flux)
+                snr = np.where(good, flux*np.sqrt(np.clip(self.spectra.ivar[band], 0, None)), np.inf)
+                ngood = np.sum(good, axis=1)
+                #- Median of each row, infinite values (masked pixels) being sorted at the end
+                snr = np.sort(snr, axis=1)
+                rows = np.arange(nspec)
+                lo = snr[rows, np.clip((ngood-1)//2, 0, None)]
+                hi = snr[rows, np.clip(ngood//2, 0, None)]
+                stats['snr_'+band] = np.where(ngood > 0, 0.5*(lo+hi), 0)
+                nmasked += flux.shape[1] - ngood
+                npix += flux.shape[1]
+            stats['masked_frac'] = nmasked / npix
+            self._stats = stats
+        return self._stats
+
+    def match_zcat(self, zcatalog, zcat_index=None) :
+        '''
+        Returns match_zcat_to_spectra(zcatalog, spectra)
+        '''
+        key = id(zcatalog)
+        if key not in self._matched_zcat :
+            #- zcatalog is kept in the dict, so that its id is not re-used
+            self._matched_zcat[key] = (zcatalog, match_zcat_to_spectra(zcatalog, self.spectra, zcat_index=zcat_index))
+        return self._matched_zcat[key][1]
+
+    def has_model(self) :
+        return self._model is not None
+
+    def get_model(self, zcatalog=None, model_store=None) :
+        '''
+        Model spectra (mwave, mflux), row-matched to spectra
+        Computed at first call from zcatalog (row-matched to spectra), using model_store
+        (mymodels.ModelStore) if set, else plotframes.create_model
+        '''
+        if self._model is None :
+            if model_store is not None :
+                self._model = model_store.get_models(self.spectra, zcatalog)
+            else :
+                from prospect import plotframes
+                self._model = plotframes.create_model(self.spectra, zcatalog)
+        return self._model
+
+    def set_model(self, model) :
+        '''
+        Sets model spectra (mwave, mflux), row-matched to spectra
+        '''
+        self._model = model
+
+
 def get_y_minmax(pmin, pmax, data, ispec) :
     '''
     Utility, from plotframe
     '''
-    dx = np.sort(data[np.isfinite(data)])
+    dx = data[np.isfinite(data)]
     if len(dx)==0 : return (0,0)
     imin = int(np.floor(pmin*len(dx)))
     imax = int(np.floor(pmax*len(dx)))
     if (imax >= len(dx)) : imax = len(dx)-1
+    dx = np.partition(dx, [imin, imax]) # no need for a full sort
     return (dx[imin],dx[imax])
 
 
-def miniplot_spectrum(spectra, i_spec, model=None, saveplot=None, smoothing=-1, coaddcam=True) :
+def _y_minmax_rows(pmin, pmax, data) :
     '''
-    Matplotlib version of plotspectra, to plot a given spectrum
-    Pieces of code were copy-pasted from plotspectra()
-    Smoothing option : simple gaussian filtering
+    Same as get_y_minmax, for each row of a 2D array
+    '''
+    dx = np.where(np.isfinite(data), data, np.nan)
+    dx = np.sort(dx, axis=1) # NaNs are sorted at the end
+    nfinite = np.sum(np.isfinite(dx), axis=1)
+    imin = np.floor(pmin*nfinite).astype(int)
+    imax = np.minimum(np.floor(pmax*nfinite).astype(int), nfinite-1)
+    rows = np.arange(dx.shape[0])
+    ymin = np.where(nfinite > 0, dx[rows, np.clip(imin, 0, None)], 0)
+    ymax = np.where(nfinite > 0, dx[rows, np.clip(imax, 0, None)], 0)
+    return (ymin, ymax)
+
+
+def _vignette_data(spectra, indices, model=None, smoothing=-1, coaddcam=True, context=None) :
     '''
+    Data to be plotted in vignettes of spectra[indices], computed for all spectra at once.
+    Returns (curves, ylims) :
+        curves : list of dict(color, wave, flux), flux being 2D[len(indices), nwave]
+        ylims : (ymin, ymax) arrays if smoothing > 0, else None (automatic range)
+    '''
+    if context is None : context = ViewerContext(spectra)
+    indices = np.asarray(indices)
     data=[]
     if coaddcam is True :
-        wave, flux, ivar = mycoaddcam.mycoaddcam(spectra)
-        bad = ( ivar == 0.0 )
-        flux[bad] = np.nan
-        thedat = dict(
-                band = 'coadd',
-                wave = wave,
-                flux = flux[i_spec]
-                )
-        data.append(thedat)
+        wave, flux, ivar = context.coaddcam()
+        flux = flux[indices] # copy
+        flux[ ivar[indices] == 0.0 ] = np.nan
+        data.append( dict(band='coadd', wave=wave, flux=flux) )
     else :
+        #- Set masked bins to NaN so that they won't be plotted
+        context.mask_bad_pixels()
         for band in spectra.bands :
-            #- Set masked bins to NaN so that Bokeh won't plot them
-            bad = (spectra.ivar[band] == 0.0) | (spectra.mask[band] != 0)
-            spectra.flux[band][bad] = np.nan
-            thedat=dict(
-                band = band,
-                wave = spectra.wave[band].copy(),
-                flux = spectra.flux[band][i_spec].copy()
-                )
-            data.append(thedat)
-    
+            data.append( dict(band=band, wave=spectra.wave[band], flux=spectra.flux[band][indices]) )
+
     if model is not None:
         mwave, mflux = model
-        mwave = mwave.copy() # in case of
-        mflux = mflux[i_spec].copy()
+        mflux = mflux[indices]
 
     # Gaussian smoothing
+    ylims = None
     if smoothing > 0 :
-        ymin,ymax=0,0
+        ymin = np.zeros(len(indices))
+        ymax = np.zeros(len(indices))
         for spec in data :
-            spec['wave'] = spec['wave']
-            spec['flux'] = scipy.ndimage.filters.gaussian_filter1d(spec['flux'], sigma=smoothing, mode='nearest')
-            tmpmin,tmpmax=get_y_minmax(0.01, 0.99, spec['flux'],i_spec)
-            ymin=np.nanmin((tmpmin,ymin))
-            ymax=np.nanmax((tmpmax,ymax))
+            spec['flux'] = scipy.ndimage.filters.gaussian_filter1d(spec['flux'], sigma=smoothing, axis=1, mode='nearest')
+            tmpmin, tmpmax = _y_minmax_rows(0.01, 0.99, spec['flux'])
+            ymin = np.fmin(tmpmin, ymin)
+            ymax = np.fmax(tmpmax, ymax)
+        ymin = np.where(ymin<0, ymin*1.4, ymin*0.6)
+        ymax = ymax*1.4
+        ylims = (ymin, ymax)
         if model is not None :
             mwave = mwave[int(smoothing):-int(smoothing)]
-            mflux = scipy.ndimage.filters.gaussian_filter1d(mflux, sigma=smoothing, mode='nearest')[int(smoothing):-int(smoothing)]
-    
+            mflux = scipy.ndimage.filters.gaussian_filter1d(mflux, sigma=smoothing, axis=1, mode='nearest')[:,int(smoothing):-int(smoothing)]
+
     colors = dict(b='#1f77b4', r='#d62728', z='maroon', coadd='#d62728')
     # for visibility, do not plot near-edge of band data (noise is high there):
     waverange = dict(b=[3500,5800], r=[5800,7600], z=[7600,9900], coadd=[3500,9900])
+    curves = []
     for spec in data :
         band = spec['band']
         w, = np.where( (spec['wave']>=waverange[band][0]) & (spec['wave']<=waverange[band][1]) )
-        plt.plot(spec['wave'][w],spec['flux'][w],c=colors[band])
+        curves.append( dict(color=colors[band], wave=spec['wave'][w], flux=spec['flux'][:,w]) )
     if model is not None :
-        plt.plot(mwave, mflux, c='k')
-    # No label to save space
-    if smoothing > 0 :
-        ymin = ymin*1.4 if (ymin<0) else ymin*0.6
-        ymax = ymax*1.4
-        plt.ylim((ymin,ymax))
-    # TODO : include some infos on plot
-    
-    if saveplot is not None : plt.savefig(saveplot, dpi=50) # default dpi=100, TODO tune dpi
-    else : print("No plot saved?") # TODO saveplot kwd optional or not ?
-    plt.clf()
-        
+        curves.append( dict(color='k', wave=mwave, flux=mflux) )
+
+    return (curves, ylims)
+
+
+class _MplVignetteRenderer(object):
+    '''
+    Draws vignettes with a single matplotlib (Agg) figure, whose lines are updated
+    for each vignette (no pyplot state involved).
+    The figure background, including the x axis, is rendered only once per x range;
+    for each vignette only the lines, spines and y axis are drawn on top of it.
+    Vignettes are visually identical to those drawn with one pyplot figure per spectrum,
+    but not guaranteed to be pixel-identical.
+    '''
+    def __init__(self, curves, ylims, dpi=50) :
+        import matplotlib
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.curves = curves
+        self.ylims = ylims
+        # default dpi=100, TODO tune dpi
+        self.fig = Figure(figsize=matplotlib.rcParams['figure.figsize'], dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111)
+        self.lines = [ self.ax.plot(curve['wave'], curve['flux'][0], c=curve['color'])[0] for curve in curves ]
+        self._foreground = self.lines + list(self.ax.spines.values()) + [self.ax.yaxis]
+        self._background = None
+        self._background_xlim = None
+        # No label to save space
+        # TODO : include some infos on plot
+
+    def _draw_background(self) :
+        for artist in self._foreground : artist.set_visible(False)
+        self.canvas.draw()
+        self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._background_xlim = self.ax.get_xlim()
+        for artist in self._foreground : artist.set_visible(True)
+
+    def _draw(self, i) :
+        for curve, line in zip(self.curves, self.lines) :
+            line.set_ydata(curve['flux'][i])
+        self.ax.relim()
+        self.ax.autoscale_view()
+        if self.ylims is not None :
+            ymin, ymax = self.ylims[0][i], self.ylims[1][i]
+            if ymin == ymax :
+                #- Flat or fully masked spectrum : pad the range, as utils_raster does
+                delta = abs(ymin)*0.05 if ymin != 0 else 0.05
+                ymin, ymax = ymin-delta, ymax+delta
+            self.ax.set_ylim((ymin, ymax))
+            self.ax.set_autoscaley_on(True)
+        if self.ax.get_xlim() != self._background_xlim :
+            self._draw_background()
+        self.canvas.restore_region(self._background)
+        for artist in self._foreground :
+            self.ax.draw_artist(artist)
+
+    def render_image(self, i) :
+        '''
+        Returns vignette i as 3D[height, width, 3] uint8 array
+        '''
+        self._draw(i)
+        return np.asarray(self.canvas.buffer_rgba())[:,:,:3].copy()
+
+    def render(self, i, filename) :
+        import matplotlib.image
+
+        self._draw(i)
+        matplotlib.image.imsave(filename, np.asarray(self.canvas.buffer_rgba()), format='png', dpi=self.fig.dpi)
+
+
+def _vignette_renderer(curves, ylims, backend='matplotlib') :
+    '''
+    Returns vignette renderer for a given backend :
+        'matplotlib' : _MplVignetteRenderer
+        'raster' : utils_raster.RasterVignetteRenderer, faster, no tick labels, does not import matplotlib
+    '''
+    if backend == 'matplotlib' :
+        return _MplVignetteRenderer(curves, ylims)
+    elif backend == 'raster' :
+        from prospect import utils_raster
+        return utils_raster.RasterVignetteRenderer(curves, ylims)
+    raise ValueError("Unknown vignette backend "+str(backend))
+
+
+def miniplot_spectra(spectra, saveplots, model=None, smoothing=-1, coaddcam=True, zcatalog=None, model_store=None, context=None, backend='matplotlib',
+                     atlas_file=None) :
+    '''
+    Matplotlib version of plotspectra, to plot vignettes of all spectra at once
+        saveplots : list of png files, one per spectrum
+        atlas_file : if set, write a single png "sprite sheet" with all vignettes, and a json file
+            with their positions (see utils_raster.write_atlas); saveplots are then only used as
+            vignette names, and no individual png file is written
+    Smoothing, masking and y-range are computed for all spectra together, and all vignettes
+    are drawn with the same figure.
+    If model is None, model can be taken from model_store (mymodels.ModelStore),
+        zcatalog being then row-matched to spectra
+    context : ViewerContext for spectra, eg. shared with plotspectra
+    backend : 'matplotlib' or 'raster' (see _vignette_renderer)
+    '''
+    assert len(saveplots) == spectra.num_spectra()
+    if context is None : context = ViewerContext(spectra)
+    if model is None :
+        if model_store is not None and zcatalog is not None :
+            model = context.get_model(zcatalog=zcatalog, model_store=model_store)
+        elif context.has_model() :
+            model = context.get_model()
+
+    indices = np.arange(spectra.num_spectra())
+    curves, ylims = _vignette_data(spectra, indices, model=model, smoothing=smoothing, coaddcam=coaddcam, context=context)
+    renderer = _vignette_renderer(curves, ylims, backend=backend)
+    if atlas_file is not None :
+        from prospect import utils_raster
+        images = [ renderer.render_image(i) for i in range(len(saveplots)) ]
+        utils_raster.write_atlas(atlas_file, images, [ os.path.basename(x) for x in saveplots ])
+    else :
+        for i, saveplot in enumerate(saveplots) :
+            renderer.render(i, saveplot)
+
+    return
+
+
+def miniplot_spectrum(spectra, i_spec, model=None, saveplot=None, smoothing=-1, coaddcam=True, zcatalog=None, model_store=None, context=None, backend='matplotlib') :
+    '''
+    Matplotlib version of plotspectra, to plot a given spectrum
+    Pieces of code were copy-pasted from plotspectra()
+    Smoothing option : simple gaussian filtering
+    If model is None, model can be taken from model_store (mymodels.ModelStore),
+        zcatalog being then row-matched to spectra
+    context : ViewerContext for spectra, shared between calls (camera coadd and model
+        are then computed only once for all spectra). If None, only spectrum i_spec is processed.
+    backend : 'matplotlib' or 'raster' (see _vignette_renderer)
+    To plot all spectra, miniplot_spectra is much faster.
+    '''
+    if saveplot is None :
+        print("No plot saved?") # TODO saveplot kwd optional or not ?
+        return
+    if context is None :
+        #- Restrict everything to spectrum i_spec
+        spectra = myspecselect.myspecselect(spectra, indices=[i_spec], view=True)
+        if model is not None : model = (model[0], model[1][i_spec:i_spec+1])
+        if zcatalog is not None : zcatalog = zcatalog[i_spec:i_spec+1]
+        i_spec = 0
+        context = ViewerContext(spectra)
+    if model is None :
+        if model_store is not None and zcatalog is not None :
+            model = context.get_model(zcatalog=zcatalog, model_store=model_store)
+        elif context.has_model() :
+            model = context.get_model()
+
+    curves, ylims = _vignette_data(spectra, [i_spec], model=model, smoothing=smoothing, coaddcam=coaddcam, context=context)
+    renderer = _vignette_renderer(curves, ylims, backend=backend)
+    renderer.render(0, saveplot)
+
     return
 
 
@@ -279,119 +586,105 @@ def frames2spectra(frames, nspec=None, startspec=None, with_scores=False, with_r
     return spectra
 
 
-def specviewer_selection(spectra, log=None, mask=None, mask_type=None, gmag_cut=None, rmag_cut=None, chi2cut=None, zbest=None, snr_cut=None) :
+def specviewer_selection(spectra, log=None, mask=None, mask_type=None, gmag_cut=None, rmag_cut=None, chi2cut=None, zbest=None, snr_cut=None,
+                         expression=None, zcat_index=None) :
     '''
     Simple sub-selection on spectra based on meta-data.
         Implemented cuts based on : target mask ; photo mag (g, r) ; chi2 from fit ; SNR (in spectra.scores, BRZ)
+        expression : selection expression on fibermap/scores/zbest columns,
+            eg "DESI_TARGET & ELG and 40<DELTACHI2<100" (see utils_selection)
+        zcat_index : output of build_zcat_index(zbest), if available
+    All cuts are combined into a single mask, and spectra are copied only once.
+    As for the individual cuts, all spectra of a selected target are kept.
+    Returns 0 if no spectra are selected.
     '''
-    
+
+    columns = utils_selection.SelectionColumns(spectra, zcatalog=zbest, zcat_index=zcat_index)
+    cuts = [] # list of (boolean array, description of the cut)
+
     # Target mask selection
     if mask is not None :
         assert mask_type in ['SV1_DESI_TARGET', 'DESI_TARGET', 'CMX_TARGET']
-        if mask_type == 'SV1_DESI_TARGET' :
-            assert ( mask in sv1_desi_mask.names() )            
-            w, = np.where( (spectra.fibermap['SV1_DESI_TARGET'] & sv1_desi_mask[mask]) )
-        elif mask_type == 'DESI_TARGET' :
-            assert ( mask in desi_mask.names() ) 
-            w, = np.where( (spectra.fibermap['DESI_TARGET'] & desi_mask[mask]) )
-        elif mask_type == 'CMX_TARGET' :
-            assert ( mask in cmx_mask.names() )
-            w, = np.where( (spectra.fibermap['CMX_TARGET'] & cmx_mask[mask]) )                
-        if len(w) == 0 :
-            if log is not None : log.info(" * No spectra with mask "+mask)
-            return 0
-        else :
-            targetids = spectra.fibermap['TARGETID'][w]
-            spectra = myspecselect.myspecselect(spectra, targets=targetids)
+        target_mask = { 'SV1_DESI_TARGET' : sv1_desi_mask, 'DESI_TARGET' : desi_mask, 'CMX_TARGET' : cmx_mask }[mask_type]
+        assert ( mask in target_mask.names() )
+        cuts.append( ( (columns[mask_type] & target_mask[mask]) != 0, "with mask "+mask ) )
 
     # Photometry selection
     if gmag_cut is not None :
         assert len(gmag_cut)==2 # Require range [gmin, gmax]
-        gmag = np.zeros(spectra.num_spectra())
-        w, = np.where( (spectra.fibermap['FLUX_G']>0) & (spectra.fibermap['MW_TRANSMISSION_G']>0) )
-        gmag[w] = -2.5*np.log10(spectra.fibermap['FLUX_G'][w]/spectra.fibermap['MW_TRANSMISSION_G'][w])+22.5
-        w, = np.where( (gmag>gmag_cut[0]) & (gmag<gmag_cut[1]) )
-        if len(w) == 0 :
-            if log is not None : log.info(" * No spectra with g_mag in requested range")
-            return 0
-        else :
-            targetids = spectra.fibermap['TARGETID'][w]
-            spectra = myspecselect.myspecselect(spectra, targets=targetids)
+        cuts.append( ( (columns['GMAG']>gmag_cut[0]) & (columns['GMAG']<gmag_cut[1]), "with g_mag in requested range" ) )
     if rmag_cut is not None :
         assert len(rmag_cut)==2 # Require range [rmin, rmax]
-        rmag = np.zeros(spectra.num_spectra())
-        w, = np.where( (spectra.fibermap['FLUX_R']>0) & (spectra.fibermap['MW_TRANSMISSION_R']>0) )
-        rmag[w] = -2.5*np.log10(spectra.fibermap['FLUX_R'][w]/spectra.fibermap['MW_TRANSMISSION_R'][w])+22.5
-        w, = np.where( (rmag>rmag_cut[0]) & (rmag<rmag_cut[1]) )
-        if len(w) == 0 :
-            if log is not None : log.info(" * No spectra with r_mag in requested range")
-            return 0
-        else :
-            targetids = spectra.fibermap['TARGETID'][w]
-            spectra = myspecselect.myspecselect(spectra, targets=targetids)
+        cuts.append( ( (columns['RMAG']>rmag_cut[0]) & (columns['RMAG']<rmag_cut[1]), "with r_mag in requested range" ) )
 
-    # SNR selection ## TODO check it !! May not work ...
+    # SNR selection
     if snr_cut is not None :
         assert ( (len(snr_cut)==2) and (spectra.scores is not None) )
         for band in ['B','R','Z'] :
-            w, = np.where( (spectra.scores['MEDIAN_CALIB_SNR_'+band]>snr_cut[0]) & (spectra.scores['MEDIAN_CALIB_SNR_'+band]<snr_cut[1]) )
-            if len(w) == 0 :
-                if log is not None : log.info(" * No spectra with MEDIAN_CALIB_SNR_"+band+" in requested range")
-                return 0
-            else :
-                targetids = spectra.fibermap['TARGETID'][w]
-                spectra = myspecselect.myspecselect(spectra, targets=targetids)
-    
+            snr = columns['MEDIAN_CALIB_SNR_'+band]
+            cuts.append( ( (snr>snr_cut[0]) & (snr<snr_cut[1]), "with MEDIAN_CALIB_SNR_"+band+" in requested range" ) )
+
     # Chi2 selection
     if chi2cut is not None :
         assert len(chi2cut)==2 # Require range [chi2min, chi2max]
         assert (zbest is not None)
-        thezb, kk = match_zcat_to_spectra(zbest,spectra)
-        w, = np.where( (thezb['DELTACHI2']>chi2cut[0]) & (thezb['DELTACHI2']<chi2cut[1]) )
-        if len(w) == 0 :
-            if log is not None : log.info(" * No target in this pixel with DeltaChi2 in requested range")
+        cuts.append( ( (columns['DELTACHI2']>chi2cut[0]) & (columns['DELTACHI2']<chi2cut[1]), "with DeltaChi2 in requested range" ) )
+
+    # Generic selection expression
+    if expression is not None :
+        selection = utils_selection.SelectionExpression(expression)
+        cuts.append( ( selection.evaluate(columns, spectra.num_spectra()), "matching '"+expression+"'" ) )
+
+    if len(cuts) == 0 : return spectra
+
+    keep = np.ones(spectra.num_spectra(), dtype=bool)
+    for cut, description in cuts :
+        keep &= cut
+        if not np.any(keep) :
+            if log is not None : log.info(" * No spectra "+description)
             return 0
-        else :
-            targetids = spectra.fibermap['TARGETID'][w]
-            spectra = myspecselect.myspecselect(spectra, targets=targetids)
+
+    # Keep all spectra of selected targets
+    targetids = np.asarray(spectra.fibermap['TARGETID'])
+    keep = np.isin(targetids, targetids[keep])
+    if np.all(keep) : return spectra
+    spectra = myspecselect.myspecselect(spectra, indices=np.where(keep)[0])
 
     return spectra
 
 
-def _coadd(wave, flux, ivar, rdat):
+def _coadd(flux, ivar, rdat):
     '''
-    Return weighted coadd of spectra
+    Return weighted coadds of groups of spectra, each group having the same number of spectra
 
     Parameters
     ----------
-    wave : 1D[nwave] array of wavelengths
-    flux : 2D[nspec, nwave] array of flux densities
-    ivar : 2D[nspec, nwave] array of inverse variances of `flux`
-    rdat : 3D[nspec, ndiag, nwave] sparse diagonals of resolution matrix
+    flux : 3D[ngroups, nspec, nwave] array of flux densities
+    ivar : 3D[ngroups, nspec, nwave] array of inverse variances of `flux`
+    rdat : 4D[ngroups, nspec, ndiag, nwave] sparse diagonals of resolution matrix
 
     Returns
     -------
-        coadded spectrum (wave, outflux, outivar, outrdat)
-    '''
-    nspec, nwave = flux.shape
-    unweightedflux = np.zeros(nwave, dtype=flux.dtype)
-    weightedflux = np.zeros(nwave, dtype=flux.dtype)
-    weights = np.zeros(nwave, dtype=flux.dtype)
-    outrdat = np.zeros(rdat[0].shape, dtype=rdat.dtype)
-    for i in range(nspec):
-        unweightedflux += flux[i]
-        weightedflux += flux[i] * ivar[i]
-        weights += ivar[i]
-        outrdat += rdat[i] * ivar[i]
+        coadded spectra (outflux, outivar, outrdat), each with first dimension ngroups
+    '''
+    nspec = flux.shape[1]
+    weights = ivar.sum(axis=1)
+    weightedflux = np.einsum('gsw,gsw->gw', flux, ivar)
+    outrdat = np.einsum('gsdw,gsw->gdw', rdat, ivar)
 
     isbad = (weights == 0)
     outflux = weightedflux / (weights + isbad)
-    outflux[isbad] = unweightedflux[isbad] / nspec
+    unweightedflux = flux.sum(axis=1) / nspec
+    outflux[isbad] = unweightedflux[isbad]
 
-    outrdat /= (weights + isbad)
+    outrdat /= (weights + isbad)[:, np.newaxis, :]
     outivar = weights
 
-    return wave, outflux, outivar, outrdat
+    return outflux, outivar, outrdat
+
+#- Max size (bytes) of resolution data coadded in one go by coadd_targets
+#- Keeps temporary arrays small : coadding is limited by memory bandwidth, not by python
+_coadd_chunk_bytes = 4*2**20
 
 def coadd_targets(spectra, targetids=None):
     '''
@@ -409,12 +702,31 @@ def coadd_targets(spectra, targetids=None):
         per camera.
 
     Note: coadds per camera but not across cameras.
+    Spectra are grouped by target with a single sort. Targets having the same number
+    of spectra are then coadded together, in chunks of at most _coadd_chunk_bytes.
+    Targets with a single spectrum are copied as they are.
     '''
     if targetids is None:
         targetids = spectra.target_ids()
+    targetids = np.asarray(targetids)
+    ntargets = len(targetids)
+
+    #- Group spectra by target : itarget = index in targetids (-1 if not kept)
+    spec_targetids = np.asarray(spectra.fibermap['TARGETID'])
+    sorter = np.argsort(targetids)
+    pos = np.searchsorted(targetids, spec_targetids, sorter=sorter)
+    pos = sorter[np.clip(pos, 0, ntargets-1)]
+    itarget = np.where(targetids[pos] == spec_targetids, pos, -1)
+    counts = np.bincount(itarget[itarget>=0], minlength=ntargets)
+    if np.any(counts == 0):
+        raise RuntimeError("Some targetids have no spectra.")
+    #- rows : spectra sorted by target, in input order within each target
+    rows, = np.where(itarget >= 0)
+    rows = rows[np.argsort(itarget[rows], kind='stable')]
+    starts = np.cumsum(counts) - counts
+    first_row = rows[starts]
 
     #- Create output arrays to fill
-    ntargets = spectra.num_targets()
     wave = dict()
     flux = dict()
     ivar = dict()
@@ -433,38 +745,29 @@ def coadd_targets(spectra, targetids=None):
         if mask is not None:
             mask[channel] = np.zeros((ntargets, nwave), dtype=spectra.mask[channel].dtype)
 
-    #- Loop over targets, coadding all spectra for each target
-    fibermap = Table(dtype=spectra.fibermap.dtype)
-    for i, targetid in enumerate(targetids):
-        ii = np.where(spectra.fibermap['TARGETID'] == targetid)[0]
-        fibermap.add_row(spectra.fibermap[ii[0]])
-        for channel in spectra.bands:
-            if len(ii) > 1:
-                outwave, outflux, outivar, outrdat = _coadd(
-                    spectra.wave[channel],
-                    spectra.flux[channel][ii],
-                    spectra.ivar[channel][ii],
-                    spectra.resolution_data[channel][ii]
-                    )
+        for nspec in np.unique(counts):
+            the_targets, = np.where(counts == nspec)
+            if nspec == 1:
+                flux[channel][the_targets] = spectra.flux[channel][first_row[the_targets]]
+                ivar[channel][the_targets] = spectra.ivar[channel][first_row[the_targets]]
+                rdat[channel][the_targets] = spectra.resolution_data[channel][first_row[the_targets]]
                 if mask is not None:
-                    outmask = spectra.mask[channel][ii[0]]
-                    for j in range(1, len(ii)):
-                        outmask |= spectra.mask[channel][ii[j]]
-            else:
-                outwave, outflux, outivar, outrdat = (
-                    spectra.wave[channel],
-                    spectra.flux[channel][ii[0]],
-                    spectra.ivar[channel][ii[0]],
-                    spectra.resolution_data[channel][ii[0]]
+                    mask[channel][the_targets] = spectra.mask[channel][first_row[the_targets]]
+                continue
+            chunk_size = max(1, _coadd_chunk_bytes // (8*nspec*ndiag*nwave))
+            for i in range(0, len(the_targets), chunk_size):
+                chunk = the_targets[i:i+chunk_size]
+                ii = rows[ (starts[chunk][:, np.newaxis] + np.arange(nspec)).ravel() ]
+                flux[channel][chunk], ivar[channel][chunk], rdat[channel][chunk] = _coadd(
+                    spectra.flux[channel][ii].reshape(len(chunk), nspec, nwave),
+                    spectra.ivar[channel][ii].reshape(len(chunk), nspec, nwave),
+                    spectra.resolution_data[channel][ii].reshape(len(chunk), nspec, ndiag, nwave)
                     )
                 if mask is not None:
-                    outmask = spectra.mask[channel][ii[0]]
+                    mask[channel][chunk] = np.bitwise_or.reduce(
+                        spectra.mask[channel][ii].reshape(len(chunk), nspec, nwave), axis=1)
 
-            flux[channel][i] = outflux
-            ivar[channel][i] = outivar
-            rdat[channel][i] = outrdat
-            if mask is not None:
-                mask[channel][i] = outmask
+    fibermap = spectra.fibermap[first_row]
 
     return desispec.spectra.Spectra(spectra.bands, wave, flux, ivar,
             mask=mask, resolution_data=rdat, fibermap=fibermap,